@@ -23,7 +23,7 @@ import unittest as ut
 import os
 from abc import ABCMeta, abstractmethod
 import volumina._testing
-from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource
+from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource, MinMaxSource
 import numpy as np
 from volumina.slicingtools import sl, slicing2shape
 try:
@@ -137,5 +137,132 @@ class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         del self.signal_emitted
         del self.slicing
 
+    def testSetRelabelingEntry( self ):
+        a = np.zeros((1,10,10,1,1), dtype=np.uint32)
+        a[0,:5] = 1
+        a[0,5:] = 2
+        source = RelabelingArraySource(a)
+        source.setRelabeling(np.arange(3, dtype=np.uint32))
+        left = (slice(0,1), slice(0,5), slice(0,10), slice(0,1), slice(0,1))
+        right = (slice(0,1), slice(5,10), slice(0,10), slice(0,1), slice(0,1))
+        source.request(left).wait()
+        source.request(right).wait()
+
+        dirty = []
+        source.isDirty.connect(dirty.append)
+        source.setRelabelingEntry(2, 0)
+        self.assertEqual( dirty, [right] )
+
+        # not seen since it was marked dirty, so nothing to update
+        del dirty[:]
+        source.setRelabelingEntry(2, 2)
+        self.assertEqual( dirty, [] )
+
+        source.request(right).wait()
+        source.setRelabelingEntry(1, 0, setDirty=False)
+        source.setRelabelingEntry(2, 0)
+        self.assertEqual( sorted(dirty), sorted([left, right]) )
+        self.assertTrue( np.all(source.request(right).wait() == 0) )
+
+    def testStridedRequestsIndexedSeparately( self ):
+        a = np.ones((1,10,10,1,1), dtype=np.uint32)
+        a[0,1::2] = 2
+        source = RelabelingArraySource(a)
+        source.setRelabeling(np.arange(3, dtype=np.uint32))
+        region = (slice(0,1), slice(0,10), slice(0,10), slice(0,1), slice(0,1))
+        strided = (slice(0,1), slice(0,10,2), slice(0,10,2), slice(0,1), slice(0,1))
+        source.request(strided).wait()
+        source.request(region).wait()
+
+        dirty = []
+        source.isDirty.connect(dirty.append)
+        source.setRelabelingEntry(2, 0)
+        self.assertEqual( dirty, [region] )
+
+    def testIndexLimit( self ):
+        a = np.zeros((1,10,10,1,1), dtype=np.uint32)
+        a[0,:5] = 1
+        source = RelabelingArraySource(a)
+        source.MAX_INDEXED_REGIONS = 1
+        source.setRelabeling(np.arange(2, dtype=np.uint32))
+        left = (slice(0,1), slice(0,5), slice(0,10), slice(0,1), slice(0,1))
+        right = (slice(0,1), slice(5,10), slice(0,10), slice(0,1), slice(0,1))
+        source.request(left).wait()
+        source.request(right).wait()
+
+        # label 1 was only seen in the region dropped from the index
+        dirty = []
+        source.isDirty.connect(dirty.append)
+        source.setRelabelingEntry(1, 0)
+        self.assertEqual( dirty, [5*(slice(None),)] )
+
+        # everything was dirty, so the index is complete again
+        del dirty[:]
+        source.request(left).wait()
+        source.setRelabelingEntry(1, 1)
+        self.assertEqual( dirty, [left] )
+
+class MinMaxSourceTest( ut.TestCase ):
+    def setUp( self ):
+        self.a = np.zeros((1,10,10,1,1), dtype=np.uint8)
+        self.a[0,:5] = 10
+        self.a[0,5:] = 20
+        self.a[0,9,9] = 200
+        self.raw = ArraySource(self.a)
+        self.source = MinMaxSource(self.raw, histogram=True)
+        self.left = (slice(0,1), slice(0,5), slice(0,10), slice(0,1), slice(0,1))
+        self.right = (slice(0,1), slice(5,10), slice(0,10), slice(0,1), slice(0,1))
+
+    def testBounds( self ):
+        bounds = []
+        self.source.boundsChanged.connect(lambda b: bounds.append(tuple(b)))
+        self.source.request(self.left).wait()
+        self.source.request(self.right).wait()
+        self.assertEqual( bounds, [(10, 10), (10, 200)] )
+        self.assertEqual( len(self.source._blockStats), 2 )
+        histogram = self.source.histogram()
+        self.assertEqual( (histogram[10], histogram[20], histogram[200]), (50, 49, 1) )
+
+        # re-requests reuse the statistics
+        self.source.request(self.right).wait()
+        self.assertEqual( len(bounds), 2 )
+
+        # the bounds follow changes of the data
+        self.a[0,9,9] = 20
+        self.raw.setDirty(self.right)
+        self.assertEqual( len(self.source._blockStats), 1 )
+        self.source.request(self.right).wait()
+        self.assertEqual( bounds[-1], (10, 20) )
+
+    def testBoundsChangeKeepsData( self ):
+        dirty, normalization = [], []
+        self.source.isDirty.connect(dirty.append)
+        self.source.normalizationDirty.connect(lambda: normalization.append(True))
+        self.source.request(self.left).wait()
+        self.source.request(self.right).wait()
+        # only the display of the data is outdated, not the data
+        self.assertEqual( dirty, [] )
+        self.assertEqual( len(normalization), 2 )
+
+    def testBoundsOfCachedBlock( self ):
+        bounds = []
+        self.source.boundsChanged.connect(lambda b: bounds.append(tuple(b)))
+        self.source.request(self.left).wait()
+        self.source.request(self.right).wait()
+
+        # dropping the right block outdates the bounds, even if only
+        # known blocks are requested afterwards
+        self.raw.setDirty(self.right)
+        self.source.request(self.left).wait()
+        self.assertEqual( bounds[-1], (10, 10) )
+
+    def testResetBounds( self ):
+        self.source.request(self.left).wait()
+        self.source.resetBounds()
+        self.assertEqual( len(self.source._blockStats), 0 )
+        self.assertEqual( self.source.histogram(), None )
+        self.source.request(self.right).wait()
+        self.assertEqual( list(self.source._bounds), [20, 200] )
+
 if __name__ == '__main__':
     ut.main()
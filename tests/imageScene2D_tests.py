@@ -23,11 +23,12 @@ import unittest as ut
 import time, datetime
 
 from PyQt4.QtGui import QImage, QPainter, QApplication, QStyleOptionGraphicsItem
+from PyQt4.QtCore import QRectF
 
 from qimage2ndarray import byte_view
 import numpy as np
 
-from volumina.imageScene2D import ImageScene2D, DirtyIndicator
+from volumina.imageScene2D import ImageScene2D, DirtyIndicator, PrefetchPlanner
 from volumina.positionModel import PositionModel
 from volumina.pixelpipeline.datasources import ConstantSource
 from volumina.pixelpipeline.imagepump import StackedImageSources
@@ -113,6 +114,20 @@ class DirtyIndicatorTest( ut.TestCase ):
         self.assertNotEqual( img, img_saved )
         painter.end()
 
+class PrefetchPlannerTest( ut.TestCase ):
+    def testOffsets( self ):
+        p = PrefetchPlanner()
+        self.assertEqual(p.offsets(3), [1,2,3])
+
+        # 20 slices/s and 0.5 s per slice: start 10 slices ahead
+        p.rendered(0.5)
+        p.moved(1, 0.0)
+        p.moved(5, 0.25)
+        self.assertEqual(p.offsets(3), [10,20,30])
+
+        p.settled()
+        self.assertEqual(p.offsets(2), [1,2])
+
 class ImageScene2DTest( ut.TestCase ):
 
     @classmethod
@@ -135,6 +150,17 @@ class ImageScene2DTest( ut.TestCase ):
         s.stackedImageSources = sims
         self.assertEqual(id(s.stackedImageSources), id(sims))
 
+    def testInvalidateViewportsKeepsRects( self ):
+        s = ImageScene2D(PositionModel(), (0,3,4), preemptive_fetch_number=0)
+        s.dataShape = (1000, 1000)
+        s.invalidateViewports(QRectF(0, 0, 100, 100))
+        s.invalidateViewports(QRectF(900, 900, 100, 100))
+        s.invalidateViewports(QRectF(10, 10, 50, 50))
+        self.assertEqual( s._pendingInvalidation,
+                          [QRectF(0, 0, 100, 100), QRectF(900, 900, 100, 100)] )
+        s._flushInvalidation()
+        self.assertEqual( s._pendingInvalidation, None )
+
 class ImageScene2D_RenderTest( ut.TestCase ):
 
     @classmethod
@@ -198,5 +224,45 @@ class ImageScene2D_RenderTest( ut.TestCase ):
         self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY))
         self.assertTrue(np.all(aimg[:,:,3] == 255))
 
+    def testRotationKeepsTileCache( self ):
+        self.renderScene(self.scene)
+        cache = self.scene._tileProvider._cache
+        self.scene._onRotateLeft()
+        self.scene._onSwapAxes()
+        self.assertTrue(self.scene._tileProvider._cache is cache)
+        with cache:
+            self.assertFalse(cache.tileDirty(self.scene._tileProvider._current_stack_id, 0))
+
+    def testLevelsShareCacheBudget( self ):
+        self.scene.dataShape = (1000, 1000)
+        self.scene.setCacheBytes(2**20)
+        providers = self.scene._tileProviders
+        self.assertTrue(len(providers) > 1)
+        self.assertEqual(self.scene.cacheBytes(), 2**20)
+        budgets = [tp.cacheUsage()[1] for tp in providers]
+        self.assertTrue(sum(budgets) <= 2**20)
+        self.assertEqual(budgets, sorted(budgets, reverse=True))
+
+    def testLevelsWithoutByteBudget( self ):
+        self.scene.dataShape = (1000, 1000)
+        self.scene.setCacheBytes(0)
+        sizes = [tp._cache_size for tp in self.scene._tileProviders]
+        self.assertEqual( sizes[0], self.scene.cacheSize() )
+        self.assertTrue( all(size < sizes[0] for size in sizes[1:]) )
+
+    def testReplacedProvidersAreClosed( self ):
+        self.renderScene(self.scene)
+        old = list(self.scene._tileProviders)
+        self.scene.setCacheBytes(2**20)
+        for tp in old:
+            self.assertFalse(tp._keepRendering)
+            self.assertFalse(tp in self.scene._tileProviders)
+        # the old providers don't react to the image sources anymore
+        stack_id = old[0]._current_stack_id
+        self.layer.visible = False
+        self.assertEqual(old[0]._current_stack_id, stack_id)
+        with old[0]._cache:
+            self.assertFalse(old[0]._cache.tileDirty(stack_id, 0))
+
 if __name__ == '__main__':
     ut.main()
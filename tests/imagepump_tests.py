@@ -24,9 +24,12 @@ from PyQt4.QtCore import QRect, QObject
 from PyQt4.QtGui import QItemSelectionModel
 
 from volumina.layerstack import LayerStackModel
-from volumina.layer import GrayscaleLayer
+import numpy
+import qimage2ndarray
+
+from volumina.layer import GrayscaleLayer, RGBALayer
 from volumina.slicingtools import SliceProjection
-from volumina.pixelpipeline.datasources import ConstantSource
+from volumina.pixelpipeline.datasources import ConstantSource, ArraySource, ChannelSource
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
 
@@ -277,5 +280,51 @@ class ImagePumpTest( ut.TestCase ):
         self.assertEqual( len(ip.stackedImageSources.getRegisteredLayers()), 0 )
 
 
+class _CountingArraySource( ArraySource ):
+    def __init__( self, array ):
+        super(_CountingArraySource, self).__init__(array)
+        self.requests = 0
+
+    def request( self, slicing ):
+        self.requests += 1
+        return super(_CountingArraySource, self).request(slicing)
+
+class MultichannelPumpTest( ut.TestCase ):
+    def testSharedChannelRequest( self ):
+        data = numpy.random.randint(10, 200, size=(1,10,12,1,4)).astype(numpy.uint8)
+        source = _CountingArraySource(data)
+        layer = RGBALayer( *[ChannelSource(source, i) for i in range(4)] )
+        lsm = LayerStackModel()
+        lsm.append(layer)
+        ip = ImagePump( lsm, SliceProjection() )
+        ims = ip.stackedImageSources.getImageSource(0)
+
+        # all four channels with a single request to the multichannel source
+        ims.request(QRect(0,0,10,12)).wait()
+        self.assertEqual( source.requests, 1 )
+
+        # the bounds of each channel are still tracked
+        for i, mm in enumerate(layer._mmSources):
+            self.assertEqual( list(mm._bounds), [data[...,i].min(), data[...,i].max()] )
+
+
+    def testChangeChannel( self ):
+        data = numpy.zeros((1,10,12,1,2), dtype=numpy.uint8)
+        data[...,1] = 255
+        layer = GrayscaleLayer( ArraySource(data), normalize=(0,255) )
+        lsm = LayerStackModel()
+        lsm.append(layer)
+        ip = ImagePump( lsm, SliceProjection() )
+        ims = ip.stackedImageSources.getImageSource(0)
+        along_through = ((0,0), (1,0))
+
+        img = ims.request(QRect(0,0,10,12), along_through).wait()
+        self.assertTrue( numpy.all(qimage2ndarray.byte_view(img)[...,:3] == 0) )
+
+        # the channel is not among along_through, but must not be served from the cache
+        ip.layerToSliceSources(layer)[0].setThrough(2, 1)
+        img = ims.request(QRect(0,0,10,12), along_through).wait()
+        self.assertTrue( numpy.all(qimage2ndarray.byte_view(img)[...,:3] == 255) )
+
 if __name__=='__main__':
     ut.main()
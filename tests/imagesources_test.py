@@ -37,10 +37,14 @@ import qimage2ndarray
 
 #volumina
 import volumina._testing
+from volumina.pixelpipeline import imagesources
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource, AlphaModulatedImageSource, RGBAImageSource, \
-    ColortableImageSource
-from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
-from volumina.layer import GrayscaleLayer, AlphaModulatedLayer, RGBALayer, ColortableLayer
+    ColortableImageSource, TRANSPARENT, OPAQUE, _CachedArrayRequest, _gray2qimage, _ChannelRequest
+from volumina.pixelpipeline.imagepool import ImagePool
+from volumina.config import cfg
+from volumina.pixelpipeline.datasources import ConstantSource, ArraySource, ChannelSource, MinMaxSource
+from volumina.pixelpipeline.slicesources import SliceSource
+from volumina.layer import GrayscaleLayer, AlphaModulatedLayer, RGBALayer, ColortableLayer, generateRandomColorTable
 
 import threading
 imagesources_thread_failures = 0
@@ -116,6 +120,47 @@ class GrayscaleImageSourceTest( ImageSourcesTestBase ):
             self.assertTrue(type(result) == QImage)
         imr.notify(check, codon="unique")
 
+    def testTransposed( self ):
+        img = self.ims.request(QRect(0,0,100,60)).wait()
+        imgT = self.ims.request(QRect(0,0,100,60), transposed=True).wait()
+        self.assertEqual( (imgT.width(), imgT.height()), (100, 60) )
+        self.assertTrue( numpy.all(qimage2ndarray.raw_view(imgT) == qimage2ndarray.raw_view(img).T) )
+
+    def testLevelsNeedCheapStrides( self ):
+        self.assertTrue( self.ims.supportsLevels )
+        # e.g. lazyflow sources compute strided requests at full resolution
+        class _FullResArraySource( ArraySource ):
+            supportsStrides = False
+        ds = MinMaxSource( _FullResArraySource(self.raw.reshape((1,) + self.raw.shape + (1,1))) )
+        ims = GrayscaleImageSource( SliceSource(ds), GrayscaleLayer( ds ))
+        self.assertFalse( ims.supportsLevels )
+
+    def testNumpyConversion( self ):
+        a = numpy.array([[0, 50, 100, 200]], dtype=numpy.uint8)
+        for dtype in (numpy.uint8, numpy.int16, numpy.uint32, numpy.uint64, numpy.float32):
+            img = _gray2qimage(a.astype(dtype), (0, 100))
+            self.assertEqual( list(qimage2ndarray.byte_view(img)[0,:,0]), [0, 127, 255, 255] )
+            self.assertTrue( numpy.all(qimage2ndarray.alpha_view(img) == 255) )
+
+    def testRawDataCache( self ):
+        through = ((0, 0),)
+        self.ims.request(QRect(0,0,100,100), through).wait()
+        self.assertEqual( self.ims._rawCache.count(self.ims._rawCacheOwner), 1 )
+        imr = self.ims.request(QRect(0,0,100,100), through)
+        self.assertTrue( isinstance(imr._arrayreq, _CachedArrayRequest) )
+
+        # changing how the data is displayed keeps the data
+        self.ims.setDirty((slice(None,None), slice(None,None)))
+        self.assertEqual( self.ims._rawCache.count(self.ims._rawCacheOwner), 1 )
+
+        # changing the data does not
+        self.ars.setDirty((slice(50,60), slice(200,210)))
+        self.assertEqual( self.ims._rawCache.count(self.ims._rawCacheOwner), 1 )
+        self.ars.setDirty((slice(50,60), slice(50,60)))
+        self.assertEqual( self.ims._rawCache.count(self.ims._rawCacheOwner), 0 )
+        imr = self.ims.request(QRect(0,0,100,100), through)
+        self.assertFalse( isinstance(imr._arrayreq, _CachedArrayRequest) )
+
     def testSetDirty( self ):
         def checkAllDirty( rect ):
             self.assertTrue( rect.isEmpty() )
@@ -285,12 +330,6 @@ class AlphaModulatedImageSourceTest2( ImageSourcesTestBase ):
         
 class ColortableImageSourceTest( ImageSourcesTestBase ):
     def setUp( self ):
-        if 'TRAVIS' in os.environ:
-            # Colortable requests require vigra, which is not installed on our Travis-CI build.
-            # Skip this test on Travis-CI.
-            import nose
-            raise nose.SkipTest
-
         super( ColortableImageSourceTest, self ).setUp()
         self.seg = numpy.zeros((6,7), dtype=numpy.uint32) 
         self.seg[0:2,:] = 0
@@ -321,6 +360,60 @@ class ColortableImageSourceTest( ImageSourcesTestBase ):
 
         imr.notify(check, codon="unique")
 
+    def testLabels64( self ):
+        seg = numpy.array([[0, 1, 2, 2**40 + 1]], dtype=numpy.uint64)
+        ars = _ArraySource2d(seg)
+        ims = ColortableImageSource( ars, ColortableLayer(ars, self.ctable) )
+        colors = qimage2ndarray.raw_view(ims.request(QRect(0,0,1,4)).wait())[0]
+        self.assertEqual( list(colors), [0, self.ctable[1], self.ctable[2], self.ctable[1]] )
+
+    def testArrayColorTable( self ):
+        expected = qimage2ndarray.raw_view(self.ims.request(QRect(0,0,512,512)).wait()).copy()
+        ctable = numpy.array(self.ctable, dtype=numpy.uint32)
+        ims = ColortableImageSource( self.ars, ColortableLayer(self.ars, ctable) )
+        result = ims.request(QRect(0,0,512,512)).wait()
+        self.assertTrue( numpy.all(qimage2ndarray.raw_view(result) == expected) )
+
+        qcolors = [QColor.fromRgba(c) for c in self.ctable]
+        ims = ColortableImageSource( self.ars, ColortableLayer(self.ars, qcolors) )
+        result = ims.request(QRect(0,0,512,512)).wait()
+        self.assertTrue( numpy.all(qimage2ndarray.raw_view(result) == expected) )
+
+        ctable = generateRandomColorTable(5, "hsv", {"v": 1.0}, zeroIsTransparent=True)
+        self.assertEqual( ctable.dtype, numpy.uint32 )
+        self.assertEqual( ctable[0], 0 )
+        for c in ctable[1:]:
+            self.assertEqual( QColor.fromRgba(int(c)).alpha(), 255 )
+            self.assertEqual( QColor.fromRgba(int(c)).value(), 255 )
+
+    def testIndexed( self ):
+        expected = qimage2ndarray.raw_view(self.ims.request(QRect(0,0,512,512)).wait()).copy()
+        cfg.set('pixelpipeline', 'indexed_colortable_tiles', 'true')
+        try:
+            imr = self.ims.request(QRect(0,0,512,512))
+            img = imr.wait()
+        finally:
+            cfg.set('pixelpipeline', 'indexed_colortable_tiles', 'false')
+        self.assertEqual( img.format(), QImage.Format_Indexed8 )
+        self.assertEqual( imr.opacityHint, OPAQUE )
+        argb = img.convertToFormat(QImage.Format_ARGB32)
+        self.assertTrue( numpy.all(qimage2ndarray.raw_view(argb) == expected) )
+
+    def testOpacityHint( self ):
+        imr = self.ims.request(QRect(0,0,512,512))
+        imr.wait()
+        self.assertEqual( imr.opacityHint, OPAQUE )
+
+        # label 0 transparent; the first two rows only contain label 0
+        ctable = [QColor(0,0,0,0).rgba()] + self.ctable[1:]
+        ims = ColortableImageSource( self.ars, ColortableLayer(self.ars, ctable) )
+        imr = ims.request(QRect(0,0,2,7))
+        imr.wait()
+        self.assertEqual( imr.opacityHint, TRANSPARENT )
+        imr = ims.request(QRect(0,0,512,512))
+        imr.wait()
+        self.assertEqual( imr.opacityHint, None )
+
     def testSetDirty( self ):
         def checkAllDirty( rect ):
             self.assertTrue( rect.isEmpty() )
@@ -343,12 +436,6 @@ class ColortableImageSourceTest( ImageSourcesTestBase ):
 
 class ColortableImageSourceTest2( ImageSourcesTestBase ):
     def setUp( self ):
-        if 'TRAVIS' in os.environ:
-            # Colortable requests require vigra, which is not installed on our Travis-CI build.
-            # Skip this test on Travis-CI.
-            import nose
-            raise nose.SkipTest
-
         super( ColortableImageSourceTest2, self ).setUp()
         self.seg = numpy.zeros((6,7), dtype=numpy.uint32)
         self.seg = numpy.ma.masked_array(self.seg, mask=numpy.zeros(self.seg.shape, dtype=bool), shrink=False)
@@ -384,6 +471,17 @@ class ColortableImageSourceTest2( ImageSourcesTestBase ):
 
         imr.notify(check, codon="unique")
 
+    def testRequestWithoutVigra( self ):
+        has_vigra = imagesources._has_vigra
+        imagesources._has_vigra = False
+        try:
+            result = self.ims.request(QRect(0,0,512,512)).wait()
+        finally:
+            imagesources._has_vigra = has_vigra
+        colors = qimage2ndarray.raw_view(result)[:,0]
+        expected = [QColor(255,0,0).rgba(), 0, QColor(0,255,0).rgba(), 0, QColor(0,0,255).rgba(), 0]
+        self.assertEqual( list(colors), expected )
+
     def testSetDirty( self ):
         def checkAllDirty( rect ):
             self.assertTrue( rect.isEmpty() )
@@ -449,6 +547,20 @@ class RGBAImageSourceTest( ImageSourcesTestBase ):
         img = self.ims_none.request(QRect(0,0,104,129)).wait()
         #img.save('none.tif')
 
+    def testMultichannel( self ):
+        source = ArraySource(self.data.reshape((1,) + self.data.shape[:2] + (1,4)))
+        channels = [SliceSource(ChannelSource(source, i)) for i in range(4)]
+        ims = RGBAImageSource( *channels, layer = RGBALayer(*channels) )
+        imr = ims.request(QRect(0,0,104,129))
+        self.assertTrue( all(isinstance(req, _ChannelRequest) for req in imr._requests) )
+        self.assertEqual( imr.wait(), self.ims_rgba.request(QRect(0,0,104,129)).wait() )
+
+    def testTransposed( self ):
+        img = self.ims_rgba.request(QRect(0,0,104,129)).wait()
+        imgT = self.ims_rgba.request(QRect(0,0,104,129), transposed=True).wait()
+        self.assertEqual( (imgT.width(), imgT.height()), (104, 129) )
+        self.assertTrue( numpy.all(qimage2ndarray.raw_view(imgT) == qimage2ndarray.raw_view(img).T) )
+
     def testOpaqueness( self ):
         ims_opaque = RGBAImageSource( self.red, self.green, self.blue, ConstantSource(), RGBALayer(self.red, self.green, self.blue, alpha_missing_value = 255), guarantees_opaqueness = True )
         self.assertTrue( ims_opaque.isOpaque() )
@@ -456,6 +568,39 @@ class RGBAImageSourceTest( ImageSourcesTestBase ):
         self.assertFalse( ims_notopaque.isOpaque() )
         
 
+#*******************************************************************************
+# I m a g e P o o l T e s t                                                    *
+#*******************************************************************************
+
+class ImagePoolTest( ut.TestCase ):
+    def testReuse( self ):
+        pool = ImagePool(2)
+        img = QImage(10, 20, QImage.Format_ARGB32)
+        pool.release(img)
+        # still referenced by 'img', so it must not be handed out
+        other = pool.acquire(10, 20, QImage.Format_ARGB32)
+        self.assertFalse(other is img)
+        self.assertEqual(len(pool), 0)
+
+        pool.release(other)
+        del other
+        self.assertEqual(len(pool), 1)
+        again = pool.acquire(10, 20, QImage.Format_ARGB32)
+        self.assertEqual(pool.stats['reused'], 1)
+        self.assertEqual((again.width(), again.height()), (10, 20))
+
+        # the size and format have to match
+        pool.release(again)
+        del again
+        img = pool.acquire(20, 10, QImage.Format_ARGB32)
+        self.assertEqual((img.width(), img.height()), (20, 10))
+        self.assertEqual(len(pool), 1)
+
+        # at most maxImages are kept
+        for i in range(3):
+            pool.release(QImage(5, 5, QImage.Format_ARGB32))
+        self.assertEqual(len(pool), 2)
+
 #*******************************************************************************
 # i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
 #*******************************************************************************
@@ -53,6 +53,25 @@ class SlicingToolsTest(unittest.TestCase):
 
         self.assertEquals(a, c)
 
+    def test_rect2slicing_step(self):
+        slicing = st.rect2slicing(self.qrect, step=4)
+        self.assertEquals(slicing, (slice(5, 7, 4), slice(10, 18, 4)))
+        self.assertEquals(st.slicing2shape(slicing), (1, 2))
+
+    def test_slicing2shape_step(self):
+        a = np.zeros((20, 20))
+        for slicing in [(slice(0, 20, 3), slice(5, 6, 2)),
+                        (slice(1, 19, 2), slice(0, 20))]:
+            self.assertEquals(st.slicing2shape(slicing), a[slicing].shape)
+
+    def test_split_strides(self):
+        a = np.arange(400).reshape(20, 20)
+        slicing = (slice(2, 17, 3), slice(5, 20))
+        contiguous, strides = st.split_strides(slicing)
+        self.assertFalse(st.is_strided(contiguous))
+        self.assertTrue(st.is_strided(slicing))
+        self.assertTrue(np.all(a[contiguous][strides] == a[slicing]))
+
 
 if __name__=='__main__':
     unittest.main()
@@ -22,11 +22,14 @@
 # time to wait (in seconds) for rendering to finish
 import unittest as ut
 import numpy as np
-from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform
+from PyQt4.QtCore import QRectF, QPoint, QPointF, QRect, QSize
+from PyQt4.QtGui import QTransform, QImage
 from qimage2ndarray import byte_view
 
-from volumina.tiling import TileProvider, Tiling
+from concurrent.futures import Future
+
+from volumina.tiling import TileProvider, Tiling, _TilesCache, RenderTask, RenderTaskExecutor, \
+                           pyramidDepth, levelForScale, get_source_render_pool
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
@@ -64,6 +67,176 @@ class TilingTest ( ut.TestCase ):
         with self.assertRaises(AssertionError):
             t.data2scene = trans
 
+    def testGeometry( self ):
+        t = Tiling((300, 200), QTransform(0,1,1,0,0,0), blockSize = 100)
+        self.assertEqual(len(t), 6)
+        self.assertEqual(t.imageRects[1], QRect(0,100,100,100))
+        self.assertEqual(t.imageRects[-1], t.imageRects[5])
+        self.assertEqual(t.containsF(QPointF(150, 50)), 3)
+        self.assertEqual(t.containsF(QPointF(250, 50)), None)
+        self.assertEqual(sorted(t.intersected(QRectF(50, 150, 100, 100))), [1, 2, 4, 5])
+        self.assertEqual(t.boundingRectF().toRect(), QRect(0, 0, 200, 300))
+
+    def testLevels( self ):
+        t = Tiling((300, 100), blockSize = 50, level=1)
+        self.assertEqual(len(t), 3)
+        self.assertEqual(t.imageRects[0], QRect(0,0,100,100))
+        self.assertEqual(t.tileImageSize(0), QSize(50,50))
+
+        t = Tiling((301, 100), blockSize = 50, level=2)
+        self.assertEqual(t.tileImageSize(len(t)-1).width(), (301 - t.imageRects[-1].x() + 3) // 4)
+
+    def testPyramid( self ):
+        self.assertEqual(pyramidDepth((100, 100), 256), 1)
+        self.assertEqual(pyramidDepth((1024, 300), 256), 3)
+        self.assertEqual(levelForScale(1.0, 3), 0)
+        self.assertEqual(levelForScale(0.5, 3), 1)
+        self.assertEqual(levelForScale(0.3, 3), 1)
+        self.assertEqual(levelForScale(0.01, 3), 2)
+        self.assertEqual(levelForScale(4.0, 3), 0)
+
+
+class TilesCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+        # every image occupies 10*10*4 = 400 bytes
+        self.img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+
+    def testUnboundedBytes( self ):
+        cache = _TilesCache('stack0', self.sims)
+        with cache:
+            for tile_id in range(10):
+                cache.updateTileIfNecessary('stack0', 'ims', tile_id, 1.0, self.img)
+            self.assertEqual( cache.usedBytes, 10*400 )
+            self.assertEqual( cache.maxBytes, 0 )
+
+    def testLruEvictionAcrossStacks( self ):
+        cache = _TilesCache('stack0', self.sims, maxbytes=3*400)
+        with cache:
+            cache.addStack('stack1')
+            cache.updateTileIfNecessary('stack0', 'ims', 0, 1.0, self.img)
+            cache.updateTileIfNecessary('stack1', 'ims', 0, 1.0, self.img)
+            cache.updateTileIfNecessary('stack0', 'ims', 1, 1.0, self.img)
+            # touch the oldest entry, so that ('stack1', 0) becomes the oldest one
+            cache.layer('stack0', 'ims', 0)
+            cache.updateTileIfNecessary('stack1', 'ims', 1, 1.0, self.img)
+
+            self.assertEqual( cache.usedBytes, 3*400 )
+            self.assertTrue( cache.layer('stack1', 'ims', 0) is None )
+            self.assertTrue( cache.layerDirty('stack1', 'ims', 0) )
+            self.assertTrue( cache.tileDirty('stack1', 0) )
+            self.assertFalse( cache.layer('stack0', 'ims', 0) is None )
+            self.assertFalse( cache.layer('stack1', 'ims', 1) is None )
+
+    def testCompositeTilesAreAccountedFor( self ):
+        cache = _TilesCache('stack0', self.sims, maxbytes=2*400)
+        with cache:
+            cache.updateTileIfNecessary('stack0', 'ims', 0, 1.0, self.img)
+            cache.setTile('stack0', 0, self.img, [], [])
+            self.assertEqual( cache.usedBytes, 2*400 )
+            cache.setTile('stack0', 1, self.img, [], [])
+            self.assertEqual( cache.usedBytes, 2*400 )
+            self.assertTrue( cache.layer('stack0', 'ims', 0) is None )
+
+    def testDroppedStackReleasesBytes( self ):
+        cache = _TilesCache('stack0', self.sims, maxstacks=1)
+        with cache:
+            cache.updateTileIfNecessary('stack0', 'ims', 0, 1.0, self.img)
+            cache.addStack('stack1')
+            self.assertEqual( cache.usedBytes, 0 )
+
+class _CancellableRequest( object ):
+    def __init__( self ):
+        self.cancelled = False
+
+    def wait( self ):
+        return QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+
+    def notify( self, callback, **kwargs ):
+        callback(self.wait(), **kwargs)
+
+    def cancel( self ):
+        self.cancelled = True
+
+class _FakeTileProvider( object ):
+    def __init__( self ):
+        self.distances = {}
+
+    def _tileDistance( self, tile_nr ):
+        return self.distances.get(tile_nr, 0.0)
+
+class RenderTaskExecutorTest( ut.TestCase ):
+    def testDiscardTasks( self ):
+        pool = RenderTaskExecutor(1)
+        try:
+            requests = [_CancellableRequest() for i in range(4)]
+            stack_ids = ['old', 'new', 'old', 'new']
+            tasks = [RenderTask(Future(), False, float(i), _FakeTileProvider(), 'ims', None, i,
+                                stack_ids[i], requests[i], None) for i in range(4)]
+            # bypass submit() so that no worker picks up the tasks
+            for task in tasks:
+                pool._work_queue.put(task)
+
+            n = pool.discard_tasks(lambda task: task.stack_id == 'old')
+            self.assertEqual( n, 2 )
+            self.assertEqual( pool._work_queue.qsize(), 2 )
+            self.assertEqual( [r.cancelled for r in requests], [True, False, True, False] )
+            self.assertTrue( tasks[0].future.cancelled() )
+            self.assertFalse( tasks[1].future.cancelled() )
+        finally:
+            pool.discard_tasks(lambda task: True)
+            pool.shutdown()
+
+    def testPriorityOrder( self ):
+        tp = _FakeTileProvider()
+        tp.distances = {0: 4.0, 1: 1.0, 2: 9.0, 3: 0.0}
+        tasks = [RenderTask(Future(), i == 3, 0.0, tp, 'ims', None, i,
+                            'stack', _CancellableRequest(), None) for i in range(4)]
+        self.assertTrue( tasks[1] < tasks[0] )
+        self.assertFalse( tasks[0] < tasks[1] )
+        # prefetch tasks come last, however close they are
+        self.assertTrue( tasks[2] < tasks[3] )
+
+        pool = RenderTaskExecutor(1)
+        try:
+            for task in tasks:
+                pool._work_queue.put(task)
+            # the focus moves: tile 2 is closest now
+            tp.distances = {0: 4.0, 1: 9.0, 2: 1.0, 3: 0.0}
+            pool.reprioritize(lambda task: True)
+            order = [pool._work_queue.get_nowait().tile_nr for i in range(4)]
+            self.assertEqual( order, [2, 0, 1, 3] )
+        finally:
+            pool.shutdown()
+
+    def testMaxRunning( self ):
+        pool = RenderTaskExecutor(1)
+        try:
+            tasks = [RenderTask(Future(), False, float(i), _FakeTileProvider(), 'ims', None, i,
+                                'stack', _CancellableRequest(), None, 1) for i in range(3)]
+            self.assertTrue( pool._startTask(tasks[0]) )
+            # the source has a task running, so the others are parked
+            self.assertFalse( pool._startTask(tasks[1]) )
+            self.assertFalse( pool._startTask(tasks[2]) )
+            self.assertEqual( pool.discard_tasks(lambda task: task.tile_nr == 2), 1 )
+            self.assertTrue( tasks[2].future.cancelled() )
+
+            # a finished task lets the next parked one go
+            pool._finishTask(tasks[0])
+            self.assertTrue( pool._work_queue.get_nowait() is tasks[1] )
+            self.assertTrue( pool._startTask(tasks[1]) )
+            pool._finishTask(tasks[1])
+            self.assertEqual( pool._running['ims'], 0 )
+        finally:
+            pool.shutdown()
+
+    def testSourcePoolGrows( self ):
+        ims = _FakeTileProvider()
+        pool = get_source_render_pool(ims, 2)
+        self.assertTrue( get_source_render_pool(ims, 4) is pool )
+        self.assertEqual( pool._max_workers, 4 )
+        self.assertEqual( get_source_render_pool(ims, 1)._max_workers, 4 )
+        pool.shutdown()
 
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
@@ -135,6 +308,110 @@ class TileProviderTest( ut.TestCase ):
             self.assertTrue(np.all(aimg[:,:,3] == 255))
 
 
+    def testCachedTiles( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        self.assertEqual( list(tp.cachedTiles(rect)), [] )
+
+        tp.requestRefresh(rect)
+        tp.waitForTiles()
+        tiles = list(tp.cachedTiles(rect))
+        self.assertEqual( [t.id for t in tiles], list(tiling.intersected(rect)) )
+
+        # outdated tiles are not offered
+        self.layer3.visible = False
+        self.assertEqual( list(tp.cachedTiles(rect)), [] )
+
+    def testPartialComposite( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        tp.requestRefresh(QRectF(100,100,200,200))
+        tp.waitForTiles()
+        stack_id = tp._current_stack_id
+        tile_no = tiling.intersected(QRectF(100,100,200,200))[0]
+
+        # layer 3 is the bottom one, layer 1 is invisible
+        self.layer2.opacity = 0.5
+        tp._renderTile(stack_id, tile_no)
+        with tp._cache:
+            partialSignature, partialImage, lastSignature = \
+                tp._cache.partialComposite(stack_id, tile_no)
+        self.assertEqual([sig[0] for sig in partialSignature], [self.ims3])
+        self.assertEqual([sig[0] for sig in lastSignature], [self.ims3, self.ims2])
+        aimg = byte_view(partialImage)
+        self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY3))
+
+    def testCompositeUsesStackSnapshot( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        tp.requestRefresh(QRectF(100,100,200,200))
+        tp.waitForTiles()
+        stack_id = tp._current_stack_id
+        tile_no = tiling.intersected(QRectF(100,100,200,200))[0]
+
+        # the layer stack changes in the GUI thread after the composite
+        # was requested
+        stack = tp._stackSnapshot()
+        cache = tp._cache
+        self.sims.deregister(self.layer2)
+        tp._renderTile(stack_id, tile_no, cache, stack.layers)
+        with cache:
+            lastSignature = cache.partialComposite(stack_id, tile_no)[2]
+            cache.setTile(stack_id, tile_no, None, stack.visible,
+                          stack.occluded, stack.layers)
+        self.assertEqual([sig[0] for sig in lastSignature], [self.ims3, self.ims2])
+
+    def testOccludedLayers( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        stack_id = tp._current_stack_id
+        img = QImage(100, 100, QImage.Format_ARGB32_Premultiplied)
+        with tp._cache:
+            self.assertEqual( tp._cache.occludedLayers(stack_id, 0), set() )
+            tp._cache.updateTileIfNecessary(stack_id, self.ims2, 0, 1.0, img, opaque=True)
+            # the opaque tile of layer 2 is blended with opacity 0.3
+            self.assertEqual( tp._cache.occludedLayers(stack_id, 0), set() )
+
+        self.layer2.opacity = 1.0
+        with tp._cache:
+            self.assertEqual( tp._cache.occludedLayers(stack_id, 0), set([self.ims3]) )
+            self.assertEqual( tp._cache.occludedLayers(stack_id, 1), set() )
+
+    def testRenderPoolPerSource( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=3, pool_per_source=True)
+        pool2 = tp._renderPool(self.ims2)
+        self.assertTrue( pool2 is tp._renderPool(self.ims2) )
+        self.assertFalse( pool2 is tp._renderPool(self.ims3) )
+        self.assertEqual( pool2._max_workers, 3 )
+
+        tp = TileProvider(tiling, self.sims, pool_per_source=False)
+        self.assertTrue( tp._renderPool(self.ims2) is tp._renderPool(self.ims3) )
+
+    def testInflightDeduplication( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        key = (tp._current_stack_id, self.ims2, 0)
+
+        future = Future()
+        tp._registerInflight(key, future, False)
+        self.assertTrue( tp._attachToInflight(key, False) )
+        self.assertTrue( tp._attachToInflight(key, True) )
+        self.assertEqual( tp.stats['deduplicated'], 2 )
+
+        # a finished task no longer absorbs submissions
+        future.set_result(None)
+        self.assertFalse( tp._attachToInflight(key, False) )
+
+        # neither does a task whose layer has become dirty in the meantime
+        future = Future()
+        tp._registerInflight(key, future, False)
+        tp._onLayerDirty(self.ims2, QRect())
+        self.assertFalse( tp._attachToInflight(key, False) )
+        self.assertEqual( tp.stats['deduplicated'], 2 )
+
+
 class DirtyPropagationTest( ut.TestCase ):
 
     def setUp( self ):
@@ -246,6 +523,50 @@ class DirtyPropagationTest( ut.TestCase ):
             # perfectly aligned with the data we changed.
             self.assertTrue(np.any(aimg[:,:,0:3] == 99))
 
+    def testPrefetchedStackIsUsed( self ):
+        self.lsm.append(self.layer1)
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+
+        tp.prefetch(QRectF(100,100,200,200), (0,3,0))
+        prefetched_id = self.pump.syncedSliceSources.idFor((0,3,0))
+        self.assertTrue(prefetched_id in tp._prefetch_stack_ids)
+
+        self.pump.syncedSliceSources.through = [0,3,0]
+        self.assertEqual(tp._current_stack_id, prefetched_id)
+        self.assertEqual(tp.prefetchStats(), (1, 0))
+
+        self.pump.syncedSliceSources.through = [0,4,0]
+        self.assertEqual(tp.prefetchStats(), (1, 1))
+
+
+    def testPrefetchSurvivesForwardMotion( self ):
+        self.lsm.append(self.layer1)
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.pump.stackedImageSources, pool_per_source=True)
+        ims = self.pump.stackedImageSources.getImageSource(0)
+        pool = tp._renderPool(ims)
+        synced = self.pump.syncedSliceSources
+        synced.through = [0,0,0]
+
+        ids = [synced.idFor((0,z,0)) for z in (1,2,3)]
+        tp._prefetch_stack_ids = set(ids)
+        # bypass submit() so that no worker picks up the tasks
+        for i, stack_id in enumerate(ids):
+            pool._work_queue.put(RenderTask(Future(), True, float(i), tp, ims, None, 0,
+                                            stack_id, _CancellableRequest(), tp._cache))
+        try:
+            synced.through = [0,1,0]
+            self.assertEqual( tp._prefetch_stack_ids, set(ids[1:]) )
+            queued = [task.stack_id for task in pool._work_queue.queue]
+            self.assertEqual( sorted(queued), sorted(ids) )
+
+            # a change of course cancels the prefetches
+            tp.cancelPrefetch()
+            queued = [task.stack_id for task in pool._work_queue.queue]
+            self.assertEqual( queued, ids[:1] )
+        finally:
+            pool.discard_tasks(lambda task: True)
 
 if __name__=='__main__':
     ut.main()
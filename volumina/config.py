@@ -25,6 +25,14 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+tile_cache_bytes: 0
+render_threads: 6
+render_pool_per_source: false
+source_render_threads: 2
+repaint_interval_ms: 16
+raw_cache_bytes: 33554432
+image_pool_size: 64
+indexed_colortable_tiles: false
 """
 
 cfg = ConfigParser.SafeConfigParser()
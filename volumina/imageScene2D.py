@@ -26,12 +26,14 @@ from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolyg
                         QGraphicsItemGroup, QGraphicsLineItem, QGraphicsTextItem, QGraphicsPolygonItem, \
                         QGraphicsRectItem
 
-from volumina.tiling import Tiling, TileProvider, TiledImageLayer
+from volumina.tiling import Tiling, TileProvider, TiledImageLayer, pyramidDepth, levelForScale
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
+from volumina.config import cfg
 
 import datetime
 import threading
+import time
 
 #*******************************************************************************
 # D i r t y I n d i c a t o r                                                  *
@@ -103,6 +105,57 @@ class DirtyIndicator(QGraphicsItem):
             self._last_zero = False
         self.update(self._tiling.tileRectFs[tileId])
 
+#*******************************************************************************
+# P r e f e t c h P l a n n e r                                                *
+#*******************************************************************************
+class PrefetchPlanner(object):
+    """
+    Decides how far ahead of the current slice to prefetch.
+
+    Navigation speed (slices per second) and the time needed to render a
+    slice are tracked as moving averages. The first prefetched slice is
+    the one the user will reach once a slice has been rendered, and
+    slices that could not be finished in time anyway are skipped.
+    """
+
+    def __init__(self, smoothing=0.5):
+        self.smoothing = smoothing
+        self.speed = 0.0   # slices per second
+        self.latency = 0.0 # seconds per slice
+        self._lastMove = None
+
+    def _average(self, old, new):
+        if old == 0:
+            return new
+        return (1 - self.smoothing) * old + self.smoothing * new
+
+    def moved(self, distance, timestamp):
+        if self._lastMove is not None:
+            dt = timestamp - self._lastMove
+            if dt > 0:
+                self.speed = self._average(self.speed, abs(distance) / dt)
+        self._lastMove = timestamp
+
+    def settled(self):
+        self.speed = 0.0
+        self._lastMove = None
+
+    def rendered(self, seconds):
+        """A slice was completely rendered after the given time."""
+        self.latency = self._average(self.latency, seconds)
+
+    def abandoned(self, seconds):
+        """The user moved on after the given time without the slice
+        being complete; only tells us that rendering takes longer."""
+        if seconds > self.latency:
+            self.rendered(seconds)
+
+    def offsets(self, n):
+        """Distances (in slices) from the current slice to prefetch;
+        at most n."""
+        step = max(1, int(math.ceil(self.speed * self.latency)))
+        return [step * i for i in range(1, n + 1)]
+
 #*******************************************************************************
 # I m a g e S c e n e 2 D                                                      *
 #*******************************************************************************
@@ -115,6 +168,10 @@ class ImageScene2D(QGraphicsScene):
     axesChanged = pyqtSignal(int, bool)
     dirtyChanged = pyqtSignal()
 
+    # stacks kept by the coarse pyramid levels at least if the tile cache
+    # has no byte budget (see _createTileProviders)
+    MIN_LEVEL_STACKS = 16
+
     @property
     def is_swapped(self):
         """
@@ -197,8 +254,8 @@ class ImageScene2D(QGraphicsScene):
         t3 = QTransform.fromTranslate(*trans)
 
         self.data2scene = t1 * t2 * t3
-        if self._tileProvider:
-            self._tileProvider.axesSwapped = self._swapped
+        for tileProvider in self._tileProviders:
+            tileProvider.axesSwapped = self._swapped
         self.axesChanged.emit(self._rotation, self._swapped)
 
     def rot90(self, transform, rect, direction):
@@ -226,8 +283,10 @@ class ImageScene2D(QGraphicsScene):
     def _finishViewMatrixChange(self):
         self.scene2data, isInvertible = self.data2scene.inverted()
         self._setSceneRect()
-        self._tiling.data2scene = self.data2scene
-        self._tileProvider._onSizeChanged()
+        # the tile caches hold images in data orientation, so they stay
+        # valid; only the geometry of the tilings changes
+        for tiling in self._tilings:
+            tiling.data2scene = self.data2scene
         QGraphicsScene.invalidate(self, self.sceneRect())
 
     @property
@@ -268,14 +327,92 @@ class ImageScene2D(QGraphicsScene):
         self.reset()
         self._finishViewMatrixChange()
 
+    def _createTileProviders(self, cache_size=100, cache_bytes=None):
+        """Create one tile provider per pyramid level, replacing the old ones.
+
+        The levels share one cache budget of cache_bytes; each level gets
+        a share proportional to the size of its tiles, i.e. the coarser
+        a level, the smaller its share. Without a byte budget, the coarse
+        levels keep fewer stacks than the full resolution level instead,
+        which bounds their memory to a small fraction of its memory.
+        """
+        self._closeTileProviders()
+        if cache_bytes is None:
+            cache_bytes = cfg.getint('pixelpipeline', 'tile_cache_bytes')
+        self._cacheBytes = cache_bytes
+        weights = [4.0**-level for level in range(len(self._tilings))]
+        for tiling, weight in zip(self._tilings, weights):
+            if cache_bytes:
+                levelCacheSize = cache_size
+                levelCacheBytes = int(cache_bytes * weight / sum(weights))
+            else:
+                # enough stacks for prefetching a few slices
+                levelCacheSize = max(int(cache_size * weight),
+                                     min(cache_size, self.MIN_LEVEL_STACKS))
+                levelCacheBytes = 0
+            tileProvider = TileProvider(tiling, self._stackedImageSources,
+                                        cache_size=levelCacheSize,
+                                        cache_bytes=levelCacheBytes)
+            tileProvider.axesSwapped = self._swapped
+            tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+            self._tileProviders.append(tileProvider)
+        self._tileProvider = self._tileProviders[0]
+
+    def _closeTileProviders(self):
+        for tileProvider in self._tileProviders:
+            tileProvider.sceneRectChanged.disconnect(self.invalidateViewports)
+            tileProvider.close()
+        self._tileProviders = []
+        self._tileProvider = None
+
     def setCacheSize(self, cache_size):
         if cache_size != self._tileProvider._cache_size:
-            self._tileProvider = TileProvider(self._tiling, self._stackedImageSources, cache_size=cache_size)
-            self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+            self._createTileProviders(cache_size=cache_size,
+                                      cache_bytes=self._cacheBytes)
 
     def cacheSize(self):
         return self._tileProvider._cache_size
 
+    def setCacheBytes(self, cache_bytes):
+        """Set the memory budget (in bytes) of the tile cache, shared by
+        all pyramid levels; 0 means no limit."""
+        if cache_bytes != self._cacheBytes:
+            self._createTileProviders(cache_size=self._tileProvider._cache_size,
+                                      cache_bytes=cache_bytes)
+
+    def cacheBytes(self):
+        return self._cacheBytes
+
+    def setLevelOfDetailEnabled(self, enable):
+        """Render downsampled tiles when the view is zoomed out."""
+        self._lod_enabled = enable
+        self.invalidate()
+
+    def levelOfDetailEnabled(self):
+        return self._lod_enabled
+
+    def _tileProviderForPainter(self, painter):
+        """Pick the tile provider of the pyramid level matching the zoom
+        factor of the painter's device transform.
+
+        Coarse levels are only used if all visible layers can deliver
+        downsampled images cheaply; otherwise a coarse tile would cost
+        more than the full resolution tiles it covers, which are shared
+        by all zoom factors.
+        """
+        level = 0
+        if self._lod_enabled and self._levelsSupported():
+            t = painter.deviceTransform()
+            scale = max(math.hypot(t.m11(), t.m12()), math.hypot(t.m21(), t.m22()))
+            level = levelForScale(scale, len(self._tileProviders))
+        self._currentLevel = level
+        return self._tileProviders[level]
+
+    def _levelsSupported(self):
+        return all(getattr(ims, 'supportsLevels', False)
+                   for visible, opacity, ims in self._stackedImageSources
+                   if visible)
+
     def setPrefetchingEnabled(self, enable):
         self._prefetching_enabled = enable
 
@@ -288,10 +425,33 @@ class ImageScene2D(QGraphicsScene):
         return self._n_preemptive
 
     def invalidateViewports(self, sceneRectF):
-        '''Call invalidate on the intersection of all observing viewport-rects and rectF.'''
-        sceneRectF = sceneRectF if sceneRectF.isValid() else self.sceneRect()
+        '''Call invalidate on the intersection of all observing viewport-rects and rectF.
+
+        The rects are collected and invalidated together at most once
+        per repaint interval, so that many finished tiles cause a single
+        repaint. They are invalidated one by one rather than as their
+        bounding rect, which would also repaint everything between two
+        distant tiles.
+        '''
+        sceneRectF = QRectF(sceneRectF if sceneRectF.isValid() else self.sceneRect())
+        if self._pendingInvalidation is None:
+            self._pendingInvalidation = []
+        if not any(pending.contains(sceneRectF) for pending in self._pendingInvalidation):
+            self._pendingInvalidation = [pending for pending in self._pendingInvalidation
+                                         if not sceneRectF.contains(pending)]
+            self._pendingInvalidation.append(sceneRectF)
+        if not self._invalidateTimer.isActive():
+            self._invalidateTimer.start()
+
+    def _flushInvalidation(self):
+        sceneRects, self._pendingInvalidation = self._pendingInvalidation, None
+        if sceneRects is None:
+            return
         for view in self.views():
-            QGraphicsScene.invalidate(self, sceneRectF.intersected(view.viewportRect()))
+            viewportRect = view.viewportRect()
+            for sceneRectF in sceneRects:
+                if sceneRectF.intersects(viewportRect):
+                    QGraphicsScene.invalidate(self, sceneRectF.intersected(viewportRect))
 
     def reset(self):
         """Reset rotations, tiling, etc. Called when first initialized
@@ -300,11 +460,14 @@ class ImageScene2D(QGraphicsScene):
         """
         self.resetAxes(finish=False)
 
-        self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name)
+        # one tiling per pyramid level; level 0 has full resolution
+        self._tilings = [Tiling(self._dataShape, self.data2scene, name=self.name, level=level)
+                         for level in range(pyramidDepth(self._dataShape))]
+        self._tiling = self._tilings[0]
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
-        self._tileProvider = TileProvider(self._tiling, self._stackedImageSources)
-        self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+        self._createTileProviders(cache_bytes=self._cacheBytes)
+        self._currentLevel = 0
 
         if self._dirtyIndicator:
             self.removeItem(self._dirtyIndicator)
@@ -345,20 +508,37 @@ class ImageScene2D(QGraphicsScene):
         self._showTileProgress = False
 
         self._tileProvider = None
+        self._tileProviders = []
+        self._cacheBytes = None
+        self._tilings = []
+        self._currentLevel = 0
+        self._lod_enabled = True
         self._dirtyIndicator = None
         self._prefetching_enabled = False
         
+        # tile updates are repainted in batches, see invalidateViewports
+        self._pendingInvalidation = None # list of scene rects
+        self._invalidateTimer = QTimer(self)
+        self._invalidateTimer.setSingleShot(True)
+        self._invalidateTimer.setInterval(cfg.getint('pixelpipeline', 'repaint_interval_ms'))
+        self._invalidateTimer.timeout.connect(self._flushInvalidation)
+
         self._swappedDefault = swapped_default
         self.reset()
 
         # BowWave preemptive caching
         self.setPreemptiveFetchNumber(preemptive_fetch_number)
         self._course = (1,1) # (along, pos or neg direction)
+        self._prefetchPlanner = PrefetchPlanner()
+        self._lastPrefetch = None
+        self._renderStart = None
+        self._renderHadToWait = False
         self._time = self._posModel.time
         self._channel = self._posModel.channel
         self._posModel.timeChanged.connect(self._onTimeChanged)
         self._posModel.channelChanged.connect(self._onChannelChanged)
         self._posModel.slicingPositionChanged.connect(self._onSlicingPositionChanged)
+        self._posModel.slicingPositionSettled.connect(self._onSlicingPositionSettled)
         
         self._allTilesCompleteEvent = threading.Event()
         self.dirty = False
@@ -404,7 +584,14 @@ class ImageScene2D(QGraphicsScene):
         if self._tileProvider is None:
             return
 
-        tiles = self._tileProvider.getTiles(sceneRectF)
+        tileProvider = self._tileProviderForPainter(painter)
+        if self.views():
+            # render from the center of the viewport outwards
+            tileProvider.setFocus(self.views()[0].viewportRect().center())
+        tiles = list(tileProvider.getTiles(sceneRectF))
+        missing = [tile.rectF for tile in tiles if tile.qimg is None]
+        if missing:
+            self._drawNeighbourLevels(painter, missing)
         allComplete = True
         for tile in tiles:
             #We always draw the tile, even though it might not be up-to-date
@@ -412,12 +599,23 @@ class ImageScene2D(QGraphicsScene):
             #new brush strokes on top
             #See also ilastik issue #132 and tests/lazy_test.py
             if tile.qimg is not None:
-                painter.drawImage(tile.rectF, tile.qimg)
+                painter.save()
+                painter.setWorldTransform(tile.tiling.data2scene, True)
+                painter.drawImage(QRectF(tile.tiling.dataRects[tile.id]), tile.qimg)
+                painter.restore()
             if tile.progress < 1.0:
                 allComplete = False
-            if self._showTileProgress:
+            if self._showTileProgress and self._currentLevel == 0:
                 self._dirtyIndicator.setTileProgress(tile.id, tile.progress)
 
+        if self._renderStart is not None:
+            if allComplete:
+                if self._renderHadToWait:
+                    self._prefetchPlanner.rendered(time.time() - self._renderStart)
+                self._renderStart = None
+            else:
+                self._renderHadToWait = True
+
         if allComplete:
             if self.dirty:
                 self.dirty = False
@@ -430,9 +628,37 @@ class ImageScene2D(QGraphicsScene):
             self._allTilesCompleteEvent.clear()
 
         # preemptive fetching
-        if self._prefetching_enabled:
-            for through in self._bowWave(self._n_preemptive):
-                self._tileProvider.prefetch(sceneRectF, through)
+        self._prefetch(tileProvider, sceneRectF)
+
+    def _drawNeighbourLevels(self, painter, sceneRects):
+        """Fill the given rects with the cached tiles of the pyramid levels
+        next to the current one, e.g. while the tiles of a level that was
+        just zoomed into are still being rendered. The finer level is
+        drawn over the coarser one."""
+        for level in (self._currentLevel + 1, self._currentLevel - 1):
+            if not 0 <= level < len(self._tileProviders):
+                continue
+            for rect in sceneRects:
+                for tile in self._tileProviders[level].cachedTiles(rect):
+                    painter.save()
+                    painter.setClipRect(rect, Qt.IntersectClip)
+                    painter.setWorldTransform(tile.tiling.data2scene, True)
+                    painter.drawImage(QRectF(tile.tiling.dataRects[tile.id]), tile.qimg)
+                    painter.restore()
+
+    def _prefetch(self, tileProvider, sceneRectF):
+        if not self._prefetching_enabled:
+            return
+        if self.views():
+            # prefetch what will be visible, not just the exposed part
+            sceneRectF = self.views()[0].viewportRect()
+        bowWave = self._bowWave(self._n_preemptive)
+        request = (tileProvider, sceneRectF, bowWave)
+        if request == self._lastPrefetch:
+            return
+        self._lastPrefetch = request
+        for through in bowWave:
+            tileProvider.prefetch(sceneRectF, through)
 
     def joinRenderingAllTiles(self, viewport_only=True, rect=None):
         """
@@ -450,7 +676,7 @@ class ImageScene2D(QGraphicsScene):
                     sceneRectF = QRectF() # invalid QRectF means 'get all tiles'
                 else:
                     sceneRectF = rect
-            self._tileProvider.waitForTiles(sceneRectF)
+            self._tileProviders[self._currentLevel].waitForTiles(sceneRectF)
         else:
             self._allTilesCompleteEvent.wait()
 
@@ -464,7 +690,7 @@ class ImageScene2D(QGraphicsScene):
         BowWave = []
 
         a = self._course[0]
-        for d in xrange(1,n+1):
+        for d in self._prefetchPlanner.offsets(n):
             m = through[a] + d * self._course[1]
             if m < t_max[a] and m >= 0:
                 t = list(through)
@@ -472,22 +698,46 @@ class ImageScene2D(QGraphicsScene):
                 BowWave.append(tuple(t))
         return BowWave
 
+    def _setCourse(self, course, distance):
+        now = time.time()
+        if self._renderStart is not None:
+            self._prefetchPlanner.abandoned(now - self._renderStart)
+        self._renderStart = now
+        self._renderHadToWait = False
+
+        if course != self._course:
+            # the prefetched slices are behind us now
+            self._prefetchPlanner.settled()
+            for tileProvider in self._tileProviders:
+                tileProvider.cancelPrefetch()
+        self._course = course
+        self._prefetchPlanner.moved(distance, now)
+
     def _onSlicingPositionChanged(self, new, old):
-        if (new[self._along[1] - 1] - old[self._along[1] - 1]) < 0:
-            self._course = (1, -1)
+        distance = new[self._along[1] - 1] - old[self._along[1] - 1]
+        if distance == 0:
+            # the slice shown by this scene did not change
+            return
+        if distance < 0:
+            self._setCourse((1, -1), distance)
         else:
-            self._course = (1, 1)
+            self._setCourse((1, 1), distance)
+
+    def _onSlicingPositionSettled(self, settled):
+        if settled:
+            self._prefetchPlanner.settled()
+            self._prefetch(self._tileProviders[self._currentLevel], self.sceneRect())
 
     def _onChannelChanged(self, new):
         if (new - self._channel) < 0:
-            self._course = (2, -1)
+            self._setCourse((2, -1), new - self._channel)
         else:
-            self._course = (2, 1)
+            self._setCourse((2, 1), new - self._channel)
         self._channel = new
 
     def _onTimeChanged(self, new):
         if (new - self._time) < 0:
-            self._course = (0, -1)
+            self._setCourse((0, -1), new - self._time)
         else:
-            self._course = (0, 1)
+            self._setCourse((0, 1), new - self._time)
         self._time = new
@@ -19,7 +19,6 @@
 # This information is also available on the ilastik web site at:
 #		   http://ilastik.org/license/
 ###############################################################################
-import colorsys
 import numpy
 
 from PyQt4.QtCore import QObject, pyqtSignal, QString
@@ -353,6 +352,7 @@ class NormalizableLayer( Layer ):
                 self._autoMinMax.append(normalize is None) # Don't auto-set normalization if the caller provided one.
                 mmSource = MinMaxSource(datasource)
                 mmSource.boundsChanged.connect(partial(self._bounds_changed, i))
+                mmSource.normalizationDirty.connect(partial(self._normalization_dirty, i))
                 wrapped_datasources[i] = mmSource
                 self._mmSources.append(mmSource)
 
@@ -376,6 +376,12 @@ class NormalizableLayer( Layer ):
         if self._autoMinMax[datasourceIdx]:
             self.set_normalize(datasourceIdx, None)
 
+    def _normalization_dirty(self, datasourceIdx):
+        # the image sources re-render with the current normalization
+        if self._autoMinMax[datasourceIdx]:
+            value = self._normalize[datasourceIdx]
+            self.normalizeChanged.emit(datasourceIdx, value[0], value[1])
+
     def resetBounds(self):
         for mm in self._mmSources:
             mm.resetBounds()
@@ -425,33 +431,48 @@ class AlphaModulatedLayer( NormalizableLayer ):
 # C o l o r t a b l e L a y e r                                                *
 #*******************************************************************************
 
-def generateRandomColors(M=256, colormodel="hsv", clamp=None, zeroIsTransparent=False):
-    """Generate a colortable with M entries.
-       colormodel: currently only 'hsv' is supported
-       clamp:      A dictionary stating which parameters of the color in the colormodel are clamped to a certain
-                   value. For example: clamp = {'v': 1.0} will ensure that the value of any generated
-                   HSV color is 1.0. All other parameters (h,s in the example) are selected randomly
-                   to lie uniformly in the allowed range. """
+def _hsv2rgb(h, s, v):
+    """Vectorized colorsys.hsv_to_rgb(); h, s, v are arrays of the same shape."""
+    i = numpy.floor(h*6.0)
+    f = h*6.0 - i
+    i = i.astype(numpy.int8) % 6
+    p = v*(1.0 - s)
+    q = v*(1.0 - s*f)
+    t = v*(1.0 - s*(1.0 - f))
+    r = numpy.choose(i, [v, q, p, p, t, v])
+    g = numpy.choose(i, [t, v, v, q, p, p])
+    b = numpy.choose(i, [p, p, t, v, v, q])
+    return r, g, b
+
+def generateRandomColorTable(M=256, colormodel="hsv", clamp=None, zeroIsTransparent=False):
+    """Like generateRandomColors(), but returns the colortable as an array
+       of M packed ARGB32 (QRgb) values of type uint32. The colortables
+       of ColortableLayers are lists; the image sources accept such an
+       array as well. """
     r = numpy.random.random((M, 3))
     if clamp is not None:
         for k,v in clamp.iteritems():
             idx = colormodel.index(k)
             r[:,idx] = v
 
-    colors = []
     if colormodel == "hsv":
-        for i in range(M):
-            if zeroIsTransparent and i == 0:
-                colors.append(QColor(0, 0, 0, 0).rgba())
-            else:
-                h, s, v = r[i,:] 
-                color = numpy.asarray(colorsys.hsv_to_rgb(h, s, v)) * 255
-                qColor = QColor(*color)
-                colors.append(qColor.rgba())
+        rgb = [(c * 255).astype(numpy.uint32) for c in _hsv2rgb(r[:,0], r[:,1], r[:,2])]
+        colors = numpy.uint32(0xff000000) | rgb[0] << 16 | rgb[1] << 8 | rgb[2]
+        if zeroIsTransparent and M > 0:
+            colors[0] = QColor(0, 0, 0, 0).rgba()
         return colors
     else:
         raise RuntimeError("unknown color model '%s'" % colormodel)
 
+def generateRandomColors(M=256, colormodel="hsv", clamp=None, zeroIsTransparent=False):
+    """Generate a colortable with M entries.
+       colormodel: currently only 'hsv' is supported
+       clamp:      A dictionary stating which parameters of the color in the colormodel are clamped to a certain
+                   value. For example: clamp = {'v': 1.0} will ensure that the value of any generated
+                   HSV color is 1.0. All other parameters (h,s in the example) are selected randomly
+                   to lie uniformly in the allowed range. """
+    return generateRandomColorTable(M, colormodel, clamp, zeroIsTransparent).tolist()
+
 class ColortableLayer( NormalizableLayer ):
     colorTableChanged = pyqtSignal()
 
@@ -469,7 +490,7 @@ class ColortableLayer( NormalizableLayer ):
         
     def isDifferentEnough(self, other_layer):
             
-        if other_layer._colorTable != self._colorTable:
+        if not numpy.array_equal(other_layer._colorTable, self._colorTable):
             return True
         if other_layer.datasources != self.datasources:
             return True
@@ -485,6 +506,9 @@ class ColortableLayer( NormalizableLayer ):
         your data will be automatically normalized to the length of your colorable.  
         If a tuple (dmin, dmax) is passed, this specifies the range of your data, 
         which is used to normalize the data before the colorable is applied.
+
+        Without normalization, 64-bit labels are wrapped into the colortable
+        (skipping its first entry) and label 0 is transparent.
         """
 
 
@@ -22,12 +22,13 @@
 import sys
 import threading
 import weakref
+from collections import OrderedDict
 from functools import partial, wraps
 from PyQt4.QtCore import QObject, pyqtSignal, QTimer
 from asyncabcs import RequestABC, SourceABC, IndeterminateRequestError
 import volumina
 from volumina.slicingtools import is_pure_slicing, slicing2shape, \
-    is_bounded, make_bounded, index2slice, sl
+    is_bounded, make_bounded, index2slice, sl, split_strides, is_strided
 from volumina.config import cfg
 import numpy as np
 
@@ -123,6 +124,16 @@ class ArraySource( QObject ):
 
 assert issubclass(ArraySource, SourceABC)
 
+def stridesSupported( source ):
+    '''Whether requesting a strided slicing (as done for downsampled
+    pyramid levels) from source only computes the selected elements.
+
+    Sources that compute the whole block and stride the result set
+    their supportsStrides attribute to False.
+
+    '''
+    return getattr(source, 'supportsStrides', True)
+
 #*******************************************************************************
 # A r r a y S i n k S o u r c e                                                *
 #*******************************************************************************
@@ -147,12 +158,33 @@ class ArraySinkSource( ArraySource ):
 
 class RelabelingArraySource( ArraySource ):
     """Applies a relabeling to each request before passing it on
-       Currently, it casts everything to uint8, so be careful."""
+       Currently, it casts everything to uint8, so be careful.
+
+       While a relabeling is set, the source keeps an index of the labels
+       occurring in each requested region. Changing the relabeling of a
+       single label then only marks the regions containing it as dirty."""
     isDirty = pyqtSignal( object )
+
+    # relabeling a label that occurs in more regions marks everything dirty
+    MAX_DIRTY_REGIONS = 256
+    # number of regions in the label index; the least recently requested
+    # ones are dropped from it
+    MAX_INDEXED_REGIONS = 4096
+
     def __init__( self, array ):
         super(RelabelingArraySource, self).__init__(array)
         self.originalData = array
         self._relabeling = None
+        self._lock = threading.Lock()
+        # label -> set of regions, region -> labels; a region is a tuple
+        # of (start, stop, step) triples
+        self._labelRegions = {}
+        self._regionLabels = OrderedDict()
+        # regions have been dropped from the index, so it doesn't know
+        # all regions in which a label occurs
+        self._incompleteIndex = False
+        # labels whose relabeling changed without marking them dirty yet
+        self._pendingLabels = set()
     
     def setRelabeling( self, relabeling ):
         """Sets new relabeling vector. It should have a len(relabling) == max(your data)+1
@@ -170,10 +202,30 @@ class RelabelingArraySource( ArraySource ):
            relabeling[index] =  value.
            
            If setDirty is true, the source will signal dirtyness. If you plan to issue many calls to this function
-           in a loop, setDirty to true only on the last call."""
+           in a loop, setDirty to true only on the last call.
+
+           Only the regions in which the changed labels have been seen are
+           marked dirty, unless regions have been dropped from the label
+           index."""
         self._relabeling[index] = value
+        self._pendingLabels.add(index)
         if setDirty:
-            self.setDirty(5*(slice(None),))
+            with self._lock:
+                regions = set()
+                for label in self._pendingLabels:
+                    regions.update(self._labelRegions.get(label, ()))
+                self._pendingLabels = set()
+                incomplete = self._incompleteIndex
+            if incomplete or len(regions) > self.MAX_DIRTY_REGIONS:
+                self.setDirty(5*(slice(None),))
+            else:
+                for region in regions:
+                    self.setDirty(tuple(slice(start, stop) for start, stop, step in region))
+
+    def setDirty( self, slicing ):
+        # the data of the region may change, so forget which labels it contains
+        self._forgetRegions(slicing)
+        super(RelabelingArraySource, self).setDirty(slicing)
 
     def request( self, slicing ):
         if not is_pure_slicing(slicing):
@@ -186,10 +238,53 @@ class RelabelingArraySource( ArraySource ):
         
         #oldDtype = a.dtype
         if self._relabeling is not None:
+            self._indexRegion(slicing, a)
             a = self._relabeling[a]
         #assert a.dtype == oldDtype 
         return ArrayRequest(a, 5*(slice(None),))
-        
+
+    def _indexRegion( self, slicing, a ):
+        # a strided request only sees some of the labels of its region,
+        # so the step is part of the region
+        bounded = make_bounded(slicing, self._array.shape)
+        region = tuple((s.start, s.stop, s.step or 1) for s in bounded)
+        with self._lock:
+            if region in self._regionLabels:
+                # most recently used regions go last
+                self._regionLabels[region] = self._regionLabels.pop(region)
+                return
+        labels = np.unique(a)
+        with self._lock:
+            if region in self._regionLabels:
+                return
+            self._regionLabels[region] = labels
+            for label in labels:
+                self._labelRegions.setdefault(label, set()).add(region)
+            while len(self._regionLabels) > self.MAX_INDEXED_REGIONS:
+                self._dropRegion(next(iter(self._regionLabels)))
+                self._incompleteIndex = True
+
+    def _dropRegion( self, region ):
+        for label in self._regionLabels.pop(region):
+            regions = self._labelRegions[label]
+            regions.discard(region)
+            if not regions:
+                del self._labelRegions[label]
+
+    def _forgetRegions( self, slicing ):
+        with self._lock:
+            if not is_bounded(slicing):
+                # everything is dirty, so nothing is missing from the index
+                self._labelRegions = {}
+                self._regionLabels = OrderedDict()
+                self._incompleteIndex = False
+                return
+            slicing = make_bounded(slicing, self._array.shape)
+            def overlaps( region ):
+                return all(start < s.stop and s.start < stop
+                           for (start, stop, step), s in zip(region, slicing))
+            for region in [r for r in self._regionLabels if overlaps(r)]:
+                self._dropRegion(region)
 
 if _has_lazyflow:
     from lazyflow.graph import Slot
@@ -219,6 +314,12 @@ if _has_lazyflow:
             shape = op.Output.meta.shape
             if shape is not None:
                 slicing = make_bounded(slicing, shape)
+            # lazyflow can't handle strided slicings (as used for
+            # downsampled pyramid levels), so the strides are applied
+            # to the result
+            self._strides = None
+            if is_strided(slicing):
+                slicing, self._strides = split_strides(slicing)
             self._req = op.Output[slicing]
             self._slicing = slicing
             self._shape = slicing2shape(slicing)
@@ -229,14 +330,19 @@ if _has_lazyflow:
             a = self._req.wait()
             assert(isinstance(a, np.ndarray))
             assert(a.shape == self._shape), "LazyflowRequest.wait() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
-            return a
+            return self._applyStrides(a)
             
         @translate_lf_exceptions
         def getResult(self):
             a = self._req.result
             assert(isinstance(a, np.ndarray))
             assert(a.shape == self._shape), "LazyflowRequest.getResult() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
-            return a
+            return self._applyStrides(a)
+
+        def _applyStrides( self, a ):
+            if self._strides is None:
+                return a
+            return a[self._strides]
     
         def cancel( self ):
             self._req.cancel()
@@ -262,6 +368,9 @@ if _has_lazyflow:
     class LazyflowSource( QObject ):
         isDirty = pyqtSignal( object )
         numberOfChannelsChanged = pyqtSignal(int)
+
+        # strided requests compute the full resolution block (see LazyflowRequest)
+        supportsStrides = False
     
         @property
         def dataSlot(self):
@@ -462,6 +571,71 @@ class ConstantSource( QObject ):
 assert issubclass(ConstantSource, SourceABC)
 
 
+#*******************************************************************************
+# C h a n n e l S o u r c e                                                    *
+#*******************************************************************************
+
+class ChannelSource( QObject ):
+    """A single channel of a multichannel 5d source (txyzc).
+
+    Image sources showing several channels of the same multichannel
+    source (e.g. RGBA layers) request them together with a single
+    request to 'source'."""
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int) # Never emitted
+
+    def __init__( self, source, channel ):
+        super(ChannelSource, self).__init__()
+        self.source = source
+        self.channel = channel
+        self.source.isDirty.connect(self._onSourceDirty)
+
+    @property
+    def numberOfChannels(self):
+        return 1
+
+    @property
+    def supportsStrides(self):
+        return stridesSupported(self.source)
+
+    def clean_up(self):
+        # the multichannel source is shared and owned by whoever created it
+        pass
+
+    def dtype(self):
+        return self.source.dtype()
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('ChannelSource: slicing is not pure')
+        c = slicing[-1]
+        start = self.channel + (c.start or 0)
+        stop = self.channel + (c.stop if c.stop is not None else 1)
+        return self.source.request(tuple(slicing[:-1]) + (slice(start, stop),))
+
+    def setDirty( self, slicing):
+        if not is_pure_slicing(slicing):
+            raise Exception('dirty region: slicing is not pure')
+        self.isDirty.emit( slicing )
+
+    def _onSourceDirty( self, slicing ):
+        c = slicing[-1]
+        if (c.start is None or c.start <= self.channel) and \
+           (c.stop is None or self.channel < c.stop):
+            self.setDirty(tuple(slicing[:-1]) + (slice(0,1),))
+
+    def __eq__( self, other ):
+        if other is None:
+            return False
+        return self.source == getattr(other, 'source', None) \
+               and self.channel == getattr(other, 'channel', None)
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+assert issubclass(ChannelSource, SourceABC)
+
+
 class MinMaxUpdateRequest( object ):
     def __init__( self, rawRequest, update_func ):
         self._rawRequest = rawRequest
@@ -484,41 +658,173 @@ class MinMaxUpdateRequest( object ):
     def getResult(self):
         return self._result
 
+    def cancel( self ):
+        self._rawRequest.cancel()
+
 assert issubclass(MinMaxUpdateRequest, RequestABC)
 
 
+def _blockStatistics( data, histogram=False ):
+    """(min, max, histogram) of a block of data, or None if it is empty.
+
+    With histogram=True, 8-bit integer data is counted with a single
+    np.bincount pass, from which min and max follow; the histogram has
+    256 bins, one per value of the dtype (in ascending order). Otherwise
+    the histogram is None.
+    """
+    if data.size == 0:
+        return None
+    if histogram and data.dtype.kind in 'ui' and data.dtype.itemsize == 1:
+        values = np.ma.compressed(data) if np.ma.isMaskedArray(data) else data
+        if values.size == 0:
+            return None
+        counts = np.bincount(values.view(np.uint8).ravel(), minlength=256)
+        if data.dtype.kind == 'i':
+            # negative values come after the positive ones when viewed unsigned
+            counts = np.roll(counts, 128)
+        first = np.iinfo(data.dtype).min
+        nonzero = np.flatnonzero(counts)
+        return (data.dtype.type(first + nonzero[0]),
+                data.dtype.type(first + nonzero[-1]), counts)
+    dmin, dmax = np.min(data), np.max(data)
+    if dmin is np.ma.masked:
+        return None
+    return dmin, dmax, None
+
+class _BlockStatistics( object ):
+    """Statistics of the blocks (requested regions) of a data source, keyed
+    by their slicings, from which the bounds of the whole data are derived.
+
+    Blocks are dropped when their data becomes dirty; the bounds are then
+    recomputed from the remaining blocks on the next update."""
+
+    # at most this many blocks are kept (oldest first out)
+    MAX_BLOCKS = 65536
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._bounds = None
+        self._stale = False
+
+    def __len__( self ):
+        return len(self._blocks)
+
+    @staticmethod
+    def key( slicing ):
+        return tuple((s.start, s.stop, s.step) if isinstance(s, slice) else (s, s+1, None)
+                     for s in slicing)
+
+    def get( self, key ):
+        with self._lock:
+            return self._blocks.get(key)
+
+    def put( self, key, stats ):
+        """Store the statistics of a block and return the new bounds
+        (min, max), or None if there is no data yet."""
+        with self._lock:
+            self._blocks.pop(key, None)
+            if stats is not None:
+                self._blocks[key] = stats
+                if len(self._blocks) > self.MAX_BLOCKS:
+                    self._blocks.popitem(False)
+            if self._stale:
+                self._refresh()
+            elif stats is not None:
+                self._bounds = self._union(self._bounds, stats)
+            return self._bounds
+
+    def bounds( self ):
+        """The bounds (min, max) of all blocks, or None if there is no
+        data yet."""
+        with self._lock:
+            if self._stale:
+                self._refresh()
+            return self._bounds
+
+    def _refresh( self ):
+        # blocks were dropped, so recompute the bounds from the others
+        self._bounds = None
+        for block in self._blocks.itervalues():
+            self._bounds = self._union(self._bounds, block)
+        self._stale = False
+
+    @staticmethod
+    def _union( bounds, stats ):
+        if bounds is None:
+            return stats[0], stats[1]
+        return min(bounds[0], stats[0]), max(bounds[1], stats[1])
+
+    def histogram( self ):
+        """Sum of the histograms of all blocks, or None."""
+        with self._lock:
+            histograms = [b[2] for b in self._blocks.itervalues() if b[2] is not None]
+        if not histograms:
+            return None
+        return np.sum(histograms, axis=0)
+
+    def invalidate( self, slicing=None ):
+        """Drop the blocks overlapping slicing (all blocks if None)."""
+        with self._lock:
+            if slicing is None:
+                self._blocks.clear()
+                self._bounds = None
+                return
+            region = self.key(slicing)
+            def overlaps( key ):
+                return all((start is None or s_stop is None or start < s_stop) and
+                           (s_start is None or stop is None or s_start < stop)
+                           for (start, stop, _), (s_start, s_stop, _) in zip(key, region))
+            dropped = [k for k in self._blocks if overlaps(k)]
+            for k in dropped:
+                del self._blocks[k]
+            if dropped:
+                self._stale = True
+
 class MinMaxSource( QObject ):
     """
     A datasource that serves as a normalizing decorator for other datasources.
+
+    The min/max (and, for 8-bit data, optionally a histogram) of each
+    requested block is computed once and cached; the bounds of the data
+    are derived from the cached block statistics.
     """
     isDirty = pyqtSignal( object )
     boundsChanged = pyqtSignal(object) # When a new min/max is discovered in the result of a request, this signal is fired with the new (dmin, dmax)
+    normalizationDirty = pyqtSignal() # The data has to be displayed anew since the bounds changed, but the data itself did not change
     numberOfChannelsChanged = pyqtSignal(int)
     
     _delayedBoundsChange = pyqtSignal() # Internal use only.  Allows non-main threads to start the delayedDirtySignal timer.
     
     
-    def __init__( self, rawSource, parent=None ):
+    def __init__( self, rawSource, parent=None, histogram=False ):
         """
         rawSource: The original datasource whose data will be normalized
+        histogram: Also count the values of 8-bit data (see histogram())
         """
         super(MinMaxSource, self).__init__(parent)
         
         self._rawSource = rawSource
-        self._rawSource.isDirty.connect( self.isDirty )
+        self._rawSource.isDirty.connect( self._onRawDirty )
         self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
         self._bounds = [1e9,-1e9]
+        self._histogram = histogram
+        self._blockStats = _BlockStatistics()
         
         self._delayedDirtySignal = QTimer()
         self._delayedDirtySignal.setSingleShot(True)
         self._delayedDirtySignal.setInterval(10)
-        self._delayedDirtySignal.timeout.connect( partial(self.setDirty, sl[:,:,:,:,:]) )
+        self._delayedDirtySignal.timeout.connect( self.normalizationDirty.emit )
         self._delayedBoundsChange.connect(self._delayedDirtySignal.start)
 
     @property
     def numberOfChannels(self):
         return self._rawSource.numberOfChannels
 
+    @property
+    def supportsStrides(self):
+        return stridesSupported(self._rawSource)
+
     def clean_up(self):
         self._rawSource.clean_up()
             
@@ -532,13 +838,42 @@ class MinMaxSource( QObject ):
     def dtype(self):
         return self._rawSource.dtype()
     
+    @property
+    def rawSource( self ):
+        return self._rawSource
+
     def request( self, slicing ):
         rawRequest = self._rawSource.request(slicing)
-        return MinMaxUpdateRequest( rawRequest, self._getMinMax )
+        return MinMaxUpdateRequest( rawRequest, partial(self._getMinMax, _BlockStatistics.key(slicing)) )
+
+    def update( self, slicing, data ):
+        '''Account for data of the raw source that was requested from it
+        directly (bypassing this source).'''
+        self._getMinMax(_BlockStatistics.key(slicing), data)
 
     def setDirty( self, slicing ):
         self.isDirty.emit(slicing)
 
+    def resetBounds( self ):
+        """Forget all statistics; the bounds are determined anew from the
+        blocks requested from now on."""
+        self._blockStats.invalidate()
+        self._bounds[0], self._bounds[1] = 1e9, -1e9
+        self.setDirty( sl[:,:,:,:,:] )
+
+    def histogram( self ):
+        """Histogram of the requested blocks of 8-bit data, with one bin
+        per value of the dtype, or None (see _blockStatistics())."""
+        return self._blockStats.histogram()
+
+    def _onRawDirty( self, slicing ):
+        # the data changed, so its statistics are outdated
+        if is_bounded(slicing):
+            self._blockStats.invalidate(slicing)
+        else:
+            self._blockStats.invalidate(None)
+        self.isDirty.emit(slicing)
+
     def __eq__( self, other ):
         equal = True
         if other is None:
@@ -550,15 +885,20 @@ class MinMaxSource( QObject ):
     def __ne__( self, other ):
         return not ( self == other )
 
-    def _getMinMax(self, data):
-        dmin = np.min(data)
-        dmax = np.max(data)
-        dmin = min(self._bounds[0], dmin)
-        dmax = max(self._bounds[1], dmax)
+    def _getMinMax(self, key, data):
+        if self._blockStats.get(key) is not None:
+            # the statistics of this block are known already, but the
+            # bounds are outdated if other blocks have been dropped since
+            bounds = self._blockStats.bounds()
+        else:
+            bounds = self._blockStats.put(key, _blockStatistics(data, self._histogram))
+        if bounds is None:
+            return
+        dmin, dmax = bounds
         dirty = False
-        if (self._bounds[0]-dmin) > 1e-2:
+        if abs(float(self._bounds[0]) - float(dmin)) > 1e-2:
             dirty = True
-        if (dmax-self._bounds[1]) > 1e-2:
+        if abs(float(dmax) - float(self._bounds[1])) > 1e-2:
             dirty = True
 
         if dirty:
@@ -566,7 +906,7 @@ class MinMaxSource( QObject ):
             self._bounds[1] = dmax 
             self.boundsChanged.emit(self._bounds)
 
-            # Our min/max have changed, which means we must force the TileProvider to re-request all tiles.
+            # Our min/max have changed, which means we must force the TileProvider to re-render all tiles.
             # If we simply mark everything dirty now, then nothing changes for the tile we just rendered.
             # (It was already dirty.  That's why we are rendering it right now.)
             # And when this data gets back to the TileProvider that requested it, the TileProvider will mark this tile clean again.
@@ -585,7 +925,9 @@ class MinMaxSource( QObject ):
 
             # Now, that said, we can still give a slightly more snappy response to the OTHER tiles (not this one)
             # if we immediately tell the TileProvider we are dirty.  This duplicates some requests, but that shouldn't be a big deal.
-            self.setDirty( sl[:,:,:,:,:] )
+            # The raw data has not changed, so this is not signalled by isDirty: the image
+            # sources keep their cached raw data and only convert it anew (see NormalizableLayer).
+            self.normalizationDirty.emit()
 
 
 assert issubclass(MinMaxSource, SourceABC)
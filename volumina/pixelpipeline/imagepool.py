@@ -0,0 +1,98 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import sys
+import threading
+from collections import defaultdict, Counter
+
+from PyQt4.QtGui import QImage
+from volumina.config import cfg
+
+#*******************************************************************************
+# I m a g e P o o l                                                            *
+#*******************************************************************************
+
+class ImagePool( object ):
+    '''Thread-safe pool of tile images that are no longer used, so that
+    their buffers can be reused instead of allocating new ones.
+
+    The contents of an image taken from the pool are undefined; all
+    pixels have to be written.
+
+    Released images may still be referenced elsewhere for a while (e.g.
+    by a render thread compositing them). An image is only handed out
+    again once the pool holds the last reference to it; others are
+    dropped from the pool.
+
+    '''
+    def __init__( self, maxImages ):
+        self._lock = threading.Lock()
+        self._maxImages = maxImages
+        self._count = 0
+        # (width, height, format) -> list of images
+        self._images = defaultdict(list)
+        self.stats = Counter()
+
+    def __len__( self ):
+        return self._count
+
+    def acquire( self, width, height, format ):
+        '''Return an image of the given size and format.'''
+        with self._lock:
+            images = self._images.get((width, height, format))
+            while images:
+                img = images.pop()
+                self._count -= 1
+                # referenced by 'img' and the argument of getrefcount() only
+                if sys.getrefcount(img) <= 2:
+                    self.stats['reused'] += 1
+                    return img
+                self.stats['dropped'] += 1
+            self.stats['allocated'] += 1
+        return QImage(width, height, format)
+
+    def release( self, img ):
+        '''Return an image that is not needed anymore to the pool.'''
+        if not isinstance(img, QImage) or img.isNull():
+            return
+        with self._lock:
+            if self._count >= self._maxImages:
+                return
+            self._images[(img.width(), img.height(), img.format())].append(img)
+            self._count += 1
+
+    def clear( self ):
+        with self._lock:
+            self._images.clear()
+            self._count = 0
+
+
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+def get_image_pool():
+    """The image pool shared by the whole pixel pipeline; it keeps at
+    most 'image_pool_size' (config setting) images."""
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ImagePool(cfg.getint('pixelpipeline', 'image_pool_size'))
+        return _image_pool
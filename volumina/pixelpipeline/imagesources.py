@@ -20,9 +20,12 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 #Python
+import itertools
 import logging
+import threading
 import time
 import warnings
+from collections import OrderedDict
 
 
 try:
@@ -34,10 +37,12 @@ except:
 
 from PyQt4.QtCore import QObject, QRect, pyqtSignal, QMutex
 from PyQt4.QtGui import QImage, QColor
-from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte_view
+from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte_view, raw_view
 from asyncabcs import SourceABC, RequestABC
 from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
 from volumina.config import cfg
+from volumina.pixelpipeline.imagepool import get_image_pool
+from volumina.pixelpipeline.datasources import stridesSupported
 import numpy as np
 
 _has_vigra = True
@@ -46,6 +51,195 @@ try:
 except ImportError:
     _has_vigra = False
 
+# Opacity of the result of an image request, detected cheaply while converting
+# the data. Requests expose it as their 'opacityHint' attribute after wait();
+# None means unknown or partially transparent.
+TRANSPARENT = 0
+OPAQUE = 1
+
+def _opacityOf( alpha ):
+    '''Classify an alpha channel as TRANSPARENT, OPAQUE or None.'''
+    if alpha.size == 0:
+        return None
+    if alpha.max() == 0:
+        return TRANSPARENT
+    if alpha.min() == 255:
+        return OPAQUE
+    return None
+
+#*******************************************************************************
+# R a w D a t a C a c h e                                                      *
+#*******************************************************************************
+
+def _arrayBytes( a ):
+    nbytes = a.nbytes
+    mask = np.ma.getmask(a)
+    if mask is not np.ma.nomask:
+        nbytes += mask.nbytes
+    return nbytes
+
+def _overlaps( keySlicing, slicing ):
+    for (start, stop, step), s in zip(keySlicing, slicing):
+        if s.stop is not None and s.stop <= start:
+            return False
+        if s.start is not None and stop <= s.start:
+            return False
+    return True
+
+class _RawDataCache( object ):
+    '''LRU cache for the raw 2D arrays the image sources requested from
+    their array sources, limited by the number of bytes. All image
+    sources share one cache (see get_raw_data_cache()); each entry
+    belongs to an owner, the id of the image source that stored it.
+
+    Display parameters (normalization, colors) only come into play when
+    converting the arrays to images. As long as only they change, the
+    arrays can be converted again without requesting them anew.
+
+    '''
+    def __init__( self, maxbytes ):
+        self._lock = threading.Lock()
+        self._maxbytes = maxbytes
+        self._usedbytes = 0
+        self._arrays = OrderedDict()
+        # owner -> incremented whenever data of the owner becomes invalid;
+        # arrays requested before that must not be stored
+        self._generations = {}
+
+    @property
+    def maxBytes( self ):
+        return self._maxbytes
+
+    @property
+    def usedBytes( self ):
+        return self._usedbytes
+
+    def generation( self, owner ):
+        with self._lock:
+            return self._generations.get(owner, 0)
+
+    def __len__( self ):
+        return len(self._arrays)
+
+    def count( self, owner ):
+        '''Number of arrays stored by owner.'''
+        with self._lock:
+            return sum(1 for key in self._arrays if key[0] == owner)
+
+    @staticmethod
+    def key( owner, slicing, through, channel=0 ):
+        '''through -- the position of the slice along all axes it cuts
+                      through (see _fullThrough()), not only the synced ones'''
+        return (owner, channel, through,
+                tuple((s.start, s.stop, s.step) for s in slicing))
+
+    def get( self, key ):
+        with self._lock:
+            a = self._arrays.pop(key, None)
+            if a is not None:
+                self._arrays[key] = a
+            return a
+
+    def put( self, key, a, generation ):
+        nbytes = _arrayBytes(a)
+        if nbytes > self._maxbytes:
+            return
+        with self._lock:
+            if generation != self._generations.get(key[0], 0):
+                return
+            old = self._arrays.pop(key, None)
+            if old is not None:
+                self._usedbytes -= _arrayBytes(old)
+            self._arrays[key] = a
+            self._usedbytes += nbytes
+            while self._usedbytes > self._maxbytes:
+                k, old = self._arrays.popitem(False)
+                self._usedbytes -= _arrayBytes(old)
+
+    def invalidate( self, owner, slicing=None ):
+        '''Forget the arrays of owner intersecting the 2D slicing (in all
+        slices through the volume), or all its arrays if slicing is None.'''
+        with self._lock:
+            self._generations[owner] = self._generations.get(owner, 0) + 1
+            for key in [k for k in self._arrays if k[0] == owner and
+                        (slicing is None or _overlaps(k[3], slicing))]:
+                self._usedbytes -= _arrayBytes(self._arrays.pop(key))
+
+_raw_data_cache = None
+_raw_data_cache_lock = threading.Lock()
+
+def get_raw_data_cache():
+    '''The raw data cache shared by all image sources; it keeps at most
+    'raw_cache_bytes' (config setting) bytes.'''
+    global _raw_data_cache
+    with _raw_data_cache_lock:
+        if _raw_data_cache is None:
+            _raw_data_cache = _RawDataCache(cfg.getint('pixelpipeline', 'raw_cache_bytes'))
+        return _raw_data_cache
+
+# owners of the entries of the raw data cache, one per image source
+_rawCacheOwners = itertools.count()
+
+def _fullThrough( arraySource, along_through ):
+    '''The position along all axes that a request of arraySource with
+    along_through is taken from; along_through only overrides some of
+    the axes of the slice source's current position.'''
+    through = getattr(arraySource, 'through', None)
+    if through is None:
+        return tuple(along_through)
+    through = list(through)
+    for axis, value in along_through:
+        through[axis] = value
+    return tuple(through)
+
+class _CachedArrayRequest( object ):
+    '''Request for an array that was found in the raw data cache.'''
+    def __init__( self, array ):
+        self._array = array
+
+    def wait( self ):
+        return self._array
+
+    def getResult( self ):
+        return self._array
+
+    def cancel( self ):
+        pass
+
+    def notify( self, callback, **kwargs ):
+        callback(self._array, **kwargs)
+assert issubclass(_CachedArrayRequest, RequestABC)
+
+class _CachingArrayRequest( object ):
+    '''Wraps an array request and stores its result in the raw data cache.'''
+    def __init__( self, arrayrequest, cache, key ):
+        self._arrayreq = arrayrequest
+        self._cache = cache
+        self._key = key
+        self._generation = cache.generation(key[0])
+
+    def wait( self ):
+        return self._store(self._arrayreq.wait())
+
+    def getResult( self ):
+        return self._arrayreq.getResult()
+
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def notify( self, callback, **kwargs ):
+        self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(self._store(result), **kwargs)
+
+    def _store( self, a ):
+        if a is not None:
+            self._cache.put(self._key, a, self._generation)
+        return a
+assert issubclass(_CachingArrayRequest, RequestABC)
+
 #*******************************************************************************
 # I m a g e S o u r c e                                                        *
 #*******************************************************************************
@@ -61,6 +255,15 @@ class ImageSource( QObject ):
 
     isDirty = pyqtSignal( QRect )
 
+    # Whether request() accepts a pyramid level, i.e. can deliver images
+    # downsampled by a factor of 2**level without computing them at full
+    # resolution first.
+    supportsLevels = False
+
+    # Whether request() accepts transposed=True, i.e. can deliver images
+    # whose x axis is the first axis of the slice (see TileProvider).
+    supportsTransposed = False
+
     def __init__( self, guarantees_opaqueness = False, parent = None, direct=False ):
         ''' direct: whether this request will be computed synchronously in the GUI thread (direct=True)
                     or whether the request will be put on a worker queue to be computed in a worker thread
@@ -69,8 +272,21 @@ class ImageSource( QObject ):
         super(ImageSource, self).__init__( parent = parent )
         self._opaque = guarantees_opaqueness
         self.direct = direct
+        self._rawCache = get_raw_data_cache()
+        self._rawCacheOwner = next(_rawCacheOwners)
+
+    def request( self, rect, along_through=None, level=0, transposed=False ):
+        '''Request an image of the given rectangle of the slice.
+
+        The rows of the image run along the first axis of the slice,
+        unless transposed is set.
 
-    def request( self, rect, along_through=None ):
+        level      -- pyramid level; at level l only every (2**l)-th pixel
+                      along both axes is requested (only if supportsLevels)
+        transposed -- deliver the transposed image, i.e. its x axis is the
+                      first axis of the slice (only if supportsTransposed)
+
+        '''
         raise NotImplementedError
 
     def setDirty( self, slicing ):
@@ -100,6 +316,32 @@ class ImageSource( QObject ):
 
         '''
         return self._opaque
+
+    def _requestArray( self, arraySource, slicing, along_through, channel=0 ):
+        '''Request a 2D array from one of the array sources of this image
+        source, or take it from the raw data cache.
+
+        Only requests for a definite slice (along_through given) are cached.
+
+        '''
+        if along_through is None or not self._rawCache.maxBytes:
+            return arraySource.request(slicing, along_through)
+        key = _RawDataCache.key(self._rawCacheOwner, slicing,
+                                _fullThrough(arraySource, along_through), channel)
+        a = self._rawCache.get(key)
+        if a is not None:
+            return _CachedArrayRequest(a)
+        return _CachingArrayRequest(arraySource.request(slicing, along_through),
+                                    self._rawCache, key)
+
+    def _onArrayDirty( self, slicing ):
+        '''The data of an array source changed (and not only the way it
+        is displayed).'''
+        if not is_bounded(slicing):
+            self._rawCache.invalidate(self._rawCacheOwner)
+        else:
+            self._rawCache.invalidate(self._rawCacheOwner, slicing)
+        self.setDirty(slicing)
 assert issubclass(ImageSource, SourceABC)
 
 #*******************************************************************************
@@ -110,6 +352,8 @@ class GrayscaleImageSource( ImageSource ):
     loggingName = __name__ + ".GrayscaleImageSource"
     logger = logging.getLogger(loggingName)
     
+    supportsTransposed = True
+
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(GrayscaleImageSource, self).__init__( guarantees_opaqueness = True, direct=layer.direct )
@@ -117,11 +361,15 @@ class GrayscaleImageSource( ImageSource ):
 
         self._layer = layer
         
-        self._arraySource2D.isDirty.connect(self.setDirty)
+        self._arraySource2D.isDirty.connect(self._onArrayDirty)
         if hasattr(self._layer, "normalizeChanged"):
             self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
-    def request( self, qrect, along_through=None ):
+    @property
+    def supportsLevels( self ):
+        return stridesSupported(self._arraySource2D)
+
+    def request( self, qrect, along_through=None, level=0, transposed=False ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  GrayscaleImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -130,20 +378,74 @@ class GrayscaleImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
-        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
+        s = rect2slicing(qrect, step=2**level)
+        req = self._requestArray(self._arraySource2D, s, along_through)
+        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct,
+                                      transposed=transposed )
 assert issubclass(GrayscaleImageSource, SourceABC)
 
+# lookup tables (packed ARGB32 pixels) of _gray2qimage(), by (dtype, normalize)
+_grayLuts = {}
+_MAX_GRAY_LUTS = 32
+
+def _grayLut( dtype, nmin, nmax ):
+    '''Lookup table for all values of an 8 or 16 bit integer dtype, indexed
+    by the unsigned interpretation of the values.'''
+    key = (dtype.str, nmin, nmax)
+    lut = _grayLuts.get(key)
+    if lut is None:
+        info = np.iinfo(dtype)
+        values = np.arange(info.min, info.max + 1, dtype=np.float64)
+        gray = np.clip((values - nmin) * (255.0 / (nmax - nmin)), 0, 255).astype(np.uint32)
+        lut = gray * np.uint32(0x010101) | np.uint32(0xff000000)
+        if info.min < 0:
+            # negative values come after the positive ones when viewed unsigned
+            lut = np.roll(lut, info.min)
+        if len(_grayLuts) >= _MAX_GRAY_LUTS:
+            _grayLuts.clear()
+        _grayLuts[key] = lut
+    return lut
+
+def _gray2qimage( a, normalize ):
+    '''Convert a 2D array to an opaque gray QImage (ARGB32_Premultiplied),
+    mapping the range normalize = (nmin, nmax) linearly to 0..255.
+
+    The pixels are written directly into the image buffer: 8 and 16 bit
+    integers through a lookup table, other types by scaling, clipping
+    and casting in place.
+
+    '''
+    nmin, nmax = normalize
+    img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+    out = raw_view(img)
+    if a.dtype.kind in 'ui' and a.dtype.itemsize <= 2:
+        lut = _grayLut(a.dtype, nmin, nmax)
+        indices = a.view(np.dtype('u%d' % a.dtype.itemsize))
+        np.take(lut, indices, out=out, mode='clip')
+    else:
+        ftype = np.float64 if a.dtype.itemsize > 4 else np.float32
+        gray = np.empty(a.shape, dtype=ftype)
+        np.copyto(gray, a, casting='unsafe')
+        np.subtract(gray, nmin, out=gray)
+        np.multiply(gray, 255.0 / (nmax - nmin), out=gray)
+        np.clip(gray, 0, 255, out=gray)
+        np.copyto(out, gray, casting='unsafe')
+        out *= np.uint32(0x010101)
+        out |= np.uint32(0xff000000)
+    return img
+
 class GrayscaleImageRequest( object ):
     loggingName = __name__ + ".GrayscaleImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, normalize=None, direct=False ):
+    def __init__( self, arrayrequest, normalize=None, direct=False, transposed=False ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self.direct = direct
+        self._transposed = transposed
+        # gray values are always drawn opaque
+        self.opacityHint = OPAQUE
         
     def wait(self):
         return self.toImage()
@@ -160,26 +462,22 @@ class GrayscaleImageRequest( object ):
         tAR = 1000.0*(time.time()-tAR)
         
         assert a.ndim == 2, "GrayscaleImageRequest.toImage(): result has shape %r, which is not 2-D" % (a.shape,)
+        if self._transposed:
+            a = a.T
        
         normalize = self._normalize 
         if not normalize:
             normalize = [0,255]
             
-        # FIXME: It is obviously wrong to truncate like this (right?)
-        if a.dtype == np.uint64 or a.dtype == np.int64:
-            warnings.warn("Truncating 64-bit pixels for display")
-            if a.dtype == np.uint64:
-                a = np.asanyarray(np.uint32)
-            elif a.dtype == np.int64:
-                a = np.asanyarray(np.int32)
-
         has_no_mask = not np.ma.is_masked(a)
+        # vigra does not convert 64-bit pixels; _gray2qimage() does
+        is_64bit = a.dtype == np.uint64 or a.dtype == np.int64
 
         #
         # new conversion
         #
         tImg = None
-        if has_no_mask and _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
+        if has_no_mask and not is_64bit and _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
             if self._normalize is None or \
                self._normalize[0] >= self._normalize[1] or \
                self._normalize == [0, 0]: #FIXME: fix volumina conventions
@@ -187,14 +485,21 @@ class GrayscaleImageRequest( object ):
             else:
                 n = np.asarray(self._normalize, dtype=a.dtype)
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
             if not a.flags['C_CONTIGUOUS']:
                 a = a.copy()
             vigra.colors.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
             tImg = 1000.0*(time.time()-tImg)
+        elif has_no_mask:
+            if self._normalize is None or \
+               self._normalize[0] >= self._normalize[1]:
+                n = (0, 255)
+            else:
+                n = self._normalize
+            tImg = time.time()
+            img = _gray2qimage(a, n)
+            tImg = 1000.0*(time.time()-tImg)
         else:
-            if has_no_mask:
-                self.logger.warning("using slow image creation function")
             tImg = time.time()
             if self._normalize:
                 #clipping has been implemented in this commit,
@@ -211,6 +516,9 @@ class GrayscaleImageRequest( object ):
             
         return img
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -226,15 +534,23 @@ assert issubclass(GrayscaleImageRequest, RequestABC)
 #*******************************************************************************
 
 class AlphaModulatedImageSource( ImageSource ):
+    supportsTransposed = True
+
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(AlphaModulatedImageSource, self).__init__()
         self._arraySource2D = arraySource2D
         self._layer = layer
 
-        self._arraySource2D.isDirty.connect(self.setDirty)
+        self._arraySource2D.isDirty.connect(self._onArrayDirty)
+        if hasattr(self._layer, "normalizeChanged"):
+            self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
-    def request( self, qrect, along_through=None ):
+    @property
+    def supportsLevels( self ):
+        return stridesSupported(self._arraySource2D)
+
+    def request( self, qrect, along_through=None, level=0, transposed=False ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  AlphaModulatedImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -243,20 +559,23 @@ class AlphaModulatedImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
-        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0] )
+        s = rect2slicing(qrect, step=2**level)
+        req = self._requestArray(self._arraySource2D, s, along_through)
+        return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0],
+                                           transposed )
 assert issubclass(AlphaModulatedImageSource, SourceABC)
 
 class AlphaModulatedImageRequest( object ):
     loggingName = __name__ + ".AlphaModulatedImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, tintColor, normalize=(0,255)):
+    def __init__( self, arrayrequest, tintColor, normalize=(0,255), transposed=False ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
         self._tintColor = tintColor
+        self._transposed = transposed
+        self.opacityHint = None
 
     def wait(self):
         return self.toImage()
@@ -271,6 +590,8 @@ class AlphaModulatedImageRequest( object ):
         tAR = time.time()
         a = self._arrayreq.getResult()
         tAR = 1000.0*(time.time()-tAR)
+        if self._transposed:
+            a = a.T
 
         has_no_mask = not np.ma.is_masked(a)
 
@@ -279,7 +600,7 @@ class AlphaModulatedImageRequest( object ):
             if not a.flags.contiguous:
                 a = a.copy()
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
             tintColor = np.asarray([self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF()], dtype=np.float32);
             normalize = np.asarray(self._normalize, dtype=a.dtype)
             if normalize[0] > normalize[1]:
@@ -299,6 +620,7 @@ class AlphaModulatedImageRequest( object ):
             img = array2qimage(d, normalize)
             img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
             tImg = 1000.0*(time.time()-tImg)
+        self.opacityHint = _opacityOf(alpha_view(img))
        
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
@@ -306,6 +628,9 @@ class AlphaModulatedImageRequest( object ):
             
         return img
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -324,13 +649,15 @@ class ColortableImageSource( ImageSource ):
     loggingName = __name__ + ".ColortableImageSource"
     logger = logging.getLogger(loggingName)
     
+    supportsTransposed = True
+
     def __init__( self, arraySource2D, layer ):
         """ colorTable: a list of QRgba values """
 
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(ColortableImageSource, self).__init__(direct=layer.direct)
         self._arraySource2D = arraySource2D
-        self._arraySource2D.isDirty.connect(self.setDirty)
+        self._arraySource2D.isDirty.connect(self._onArrayDirty)
 
         self._layer = layer
         self.updateColorTable()
@@ -340,24 +667,35 @@ class ColortableImageSource( ImageSource ):
 
     def updateColorTable(self):
         layerColorTable = self._layer.colorTable
-        self._colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
-
-        for i, c in enumerate(layerColorTable):
-            #note that we use qimage2ndarray.byte_view() on a QImage with Format_ARGB32 below.
-            #this means that the memory layout actually is B, G, R, A
-
-            if isinstance(c, QColor):
-                color = c
-            else: 
-                color = QColor.fromRgba(c)
-            self._colorTable[i,0] = color.blue()
-            self._colorTable[i,1] = color.green()
-            self._colorTable[i,2] = color.red()
-            self._colorTable[i,3] = color.alpha() 
+        if isinstance(layerColorTable, np.ndarray) or \
+           not any(isinstance(c, QColor) for c in layerColorTable):
+            # packed ARGB32 values (e.g. from volumina.layer.generateRandomColors),
+            # copied since pending requests keep using the old colortable
+            colorTable32 = np.array(layerColorTable, dtype=np.uint32).reshape(-1)
+            self._colorTable = colorTable32.view(np.uint8).reshape(-1, 4)
+        else:
+            self._colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
+
+            for i, c in enumerate(layerColorTable):
+                #note that we use qimage2ndarray.byte_view() on a QImage with Format_ARGB32 below.
+                #this means that the memory layout actually is B, G, R, A
+
+                if isinstance(c, QColor):
+                    color = c
+                else: 
+                    color = QColor.fromRgba(int(c))
+                self._colorTable[i,0] = color.blue()
+                self._colorTable[i,1] = color.green()
+                self._colorTable[i,2] = color.red()
+                self._colorTable[i,3] = color.alpha() 
         
         self.isDirty.emit(QRect()) # empty rect == everything is dirty
         
-    def request( self, qrect, along_through=None ):
+    @property
+    def supportsLevels( self ):
+        return stridesSupported(self._arraySource2D)
+
+    def request( self, qrect, along_through=None, level=0, transposed=False ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  ColortableImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d) = %r" \
@@ -366,22 +704,98 @@ class ColortableImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
-        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct )
+        s = rect2slicing(qrect, step=2**level)
+        req = self._requestArray(self._arraySource2D, s, along_through)
+        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct,
+                                       transposed )
 assert issubclass(ColortableImageSource, SourceABC)
 
+def _labels2qimage( a, colorTable32 ):
+    '''Color a 2D array of 64-bit labels with a colortable of ARGB32 values.
+
+    Label 0 is transparent. Label l > 0 gets the color
+    colorTable32[1 + (l-1) % (len(colorTable32)-1)], i.e. small labels
+    get their own color and larger ones wrap around, skipping entry 0.
+    Masked pixels are transparent.
+
+    '''
+    labels = np.ma.getdata(a)
+    img = get_image_pool().acquire(labels.shape[1], labels.shape[0], QImage.Format_ARGB32)
+    out = raw_view(img)
+    n = len(colorTable32)
+    if n > 1:
+        one = labels.dtype.type(1)
+        indices = labels - one
+        indices %= labels.dtype.type(n - 1)
+        indices += one
+        # all indices are in range [1, n), so they fit into an intp
+        np.take(colorTable32, indices.view(np.int64), out=out, mode='clip')
+        out[labels == 0] = 0
+    else:
+        out[...] = 0
+    if np.ma.is_masked(a):
+        out[np.ma.getmaskarray(a)] = 0
+    return img
+
+def _indexable( a, colorTable32 ):
+    '''Whether _labels2indexed() can convert the array a.'''
+    n = len(colorTable32)
+    if not 0 < n <= 256 or not issubclass(a.dtype.type, np.integer):
+        return False
+    # masked pixels need a transparent entry
+    return n < 256 or not np.ma.is_masked(a) or colorTable32[0] >> 24 == 0
+
+def _labels2indexed( a, colorTable32 ):
+    '''Color a 2D array of integer labels with a colortable of at most 256
+    ARGB32 values as an Indexed8 image. It takes a quarter of the memory
+    of an ARGB32 image and is only expanded when it is drawn.
+
+    Labels wrap around the colortable. Masked pixels get a transparent
+    entry appended to the colortable; if the colortable is full, they
+    get entry 0, which must be transparent then (see _indexable()).
+
+    '''
+    labels = np.ma.getdata(a)
+    n = len(colorTable32)
+    img = get_image_pool().acquire(labels.shape[1], labels.shape[0], QImage.Format_Indexed8)
+    out = raw_view(img)
+    if labels.dtype == np.uint8 and n == 256:
+        out[...] = labels
+    else:
+        np.copyto(out, np.remainder(labels, n), casting='unsafe')
+    colors = colorTable32
+    if np.ma.is_masked(a):
+        if n < 256:
+            colors = np.append(colorTable32, np.uint32(0))
+            out[np.ma.getmaskarray(a)] = n
+        else:
+            out[np.ma.getmaskarray(a)] = 0
+    img.setColorTable(colors.tolist())
+    return img
+
+def _indexedOpacity( img ):
+    '''Like _opacityOf(), for an Indexed8 image.'''
+    alphas = (np.asarray(img.colorTable(), dtype=np.uint32) >> 24).astype(np.uint8)
+    if alphas.min() == alphas.max():
+        return _opacityOf(alphas)
+    return _opacityOf(np.take(alphas, raw_view(img)))
+
 class ColortableImageRequest( object ):
     loggingName = __name__ + ".ColortableImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, colorTable, normalize, direct=False ):
+    def __init__( self, arrayrequest, colorTable, normalize, direct=False, transposed=False ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._colorTable = colorTable
+        # the BGRA colortable as ARGB32 pixel values (a view, not a copy)
+        self._colorTable32 = colorTable.view(np.uint32).reshape(-1)
         self.direct = direct
+        self._transposed = transposed
+        self._indexed = cfg.getboolean('pixelpipeline', 'indexed_colortable_tiles')
         self._normalize = normalize
         assert normalize is None or len(normalize) == 2
+        self.opacityHint = None
 
     def wait(self):
         return self.toImage()
@@ -398,6 +812,8 @@ class ColortableImageRequest( object ):
         tAR = 1000.0*(time.time()-tAR)
         
         assert a.ndim == 2
+        if self._transposed:
+            a = a.T
 
         if self._normalize and self._normalize[0] < self._normalize[1]:
             nmin, nmax = self._normalize
@@ -413,11 +829,23 @@ class ColortableImageRequest( object ):
             elif len(self._colorTable) <= 2**32:
                 a = np.asanyarray( a, dtype=np.uint32 )
 
-        # Use vigra if possible (much faster)
         tImg = None
-        if _has_vigra and hasattr(vigra.colors, 'applyColortable'):
+        if a.dtype == np.uint64 or a.dtype == np.int64:
+            # 64-bit labels (e.g. supervoxel ids) are wrapped into the colortable
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
+            img = _labels2qimage(a, self._colorTable32)
+            tImg = 1000.0*(time.time()-tImg)
+
+        # Small colortables: keep the labels, the colors are looked up when drawing
+        elif self._indexed and _indexable(a, self._colorTable32):
+            tImg = time.time()
+            img = _labels2indexed(a, self._colorTable32)
+            tImg = 1000.0*(time.time()-tImg)
+
+        # Use vigra if possible (much faster)
+        elif _has_vigra and hasattr(vigra.colors, 'applyColortable'):
+            tImg = time.time()
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32)
             if not issubclass( a.dtype.type, np.integer ):
                 raise NotImplementedError()
                 #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
@@ -443,11 +871,13 @@ class ColortableImageRequest( object ):
                                        " color at the beginning of the colortable for displaying masked arrays.")
 
                                 # Try to wrap the max value to a smaller value of the same color.
+                                # (on a copy, the array may be cached)
+                                a = a.copy()
                                 a[a == np.iinfo(a.dtype).max] %= len(_colorTable)
 
                         # Insert space for transparent color and shift labels up.
                         _colorTable = np.insert(_colorTable, 0, 0, axis=0)
-                        a += 1
+                        a = a + 1
                     else:
                         # Make sure the first color is transparent.
                         _colorTable = _colorTable.copy()
@@ -456,23 +886,28 @@ class ColortableImageRequest( object ):
                 # Make masked values transparent.
                 a = np.ma.filled(a, 0)
 
+            if not a.flags['C_CONTIGUOUS']:
+                a = a.copy()
             vigra.colors.applyColortable(a, _colorTable, byte_view(img))
             tImg = 1000.0*(time.time()-tImg)
 
-        # Without vigra, do it the slow way 
+        # Without vigra, look the pixels up in the colortable packed as ARGB32
         else:
-            raise NotImplementedError()
-            if _has_vigra:
-                # If this warning is annoying you, try this:
-                # warnings.filterwarnings("once")
-                warnings.warn("Using slow colortable images.  Upgrade to VIGRA > 1.9 to use faster implementation.")
-
-            #make sure that a has values in range [0, colortable_length)
-            a = np.remainder(a, len(self._colorTable))
-            #apply colortable
-            colortable = np.roll(np.fliplr(self._colorTable), -1, 1) # self._colorTable is BGRA, but array2qimage wants RGBA
-            img = colortable[a]
-            img = array2qimage(img)
+            if not issubclass( a.dtype.type, np.integer ):
+                raise NotImplementedError()
+            tImg = time.time()
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32)
+            out = raw_view(img)
+            # mode='wrap' makes sure that labels are in range [0, colortable_length)
+            np.take(self._colorTable32, np.ma.getdata(a), out=out, mode='wrap')
+            if np.ma.is_masked(a):
+                # Make masked values transparent.
+                out[np.ma.getmaskarray(a)] = 0
+            tImg = 1000.0*(time.time()-tImg)
+        if img.format() == QImage.Format_Indexed8:
+            self.opacityHint = _indexedOpacity(img)
+        else:
+            self.opacityHint = _opacityOf(alpha_view(img))
             
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
@@ -480,6 +915,9 @@ class ColortableImageRequest( object ):
 
         return img 
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -495,6 +933,8 @@ assert issubclass(ColortableImageRequest, RequestABC)
 #*******************************************************************************
 
 class RGBAImageSource( ImageSource ):
+    supportsTransposed = True
+
     def __init__( self, red, green, blue, alpha, layer, guarantees_opaqueness = False ):
         '''
         If you don't want to set all the channels,
@@ -512,9 +952,13 @@ class RGBAImageSource( ImageSource ):
         super(RGBAImageSource, self).__init__( guarantees_opaqueness = guarantees_opaqueness )
         self._channels = channels
         for arraySource in self._channels:
-            arraySource.isDirty.connect(self.setDirty)
+            arraySource.isDirty.connect(self._onArrayDirty)
 
-    def request( self, qrect, along_through=None ):
+    @property
+    def supportsLevels( self ):
+        return all(stridesSupported(channel) for channel in self._channels)
+
+    def request( self, qrect, along_through=None, level=0, transposed=False ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  RGBAImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -523,26 +967,161 @@ class RGBAImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing( qrect )
-        r = self._channels[0].request(s, along_through)
-        g = self._channels[1].request(s, along_through)
-        b = self._channels[2].request(s, along_through)
-        a = self._channels[3].request(s, along_through)
+        s = rect2slicing( qrect, step=2**level )
+        n = self._sharedChannels()
+        requests = []
+        if n > 1:
+            # a single request for the first n channels
+            shared = _SharedRequest(self._requestArray(_ChannelRange(self._channels[:n]), s,
+                                                       along_through, ('channels', n)))
+            requests = [_ChannelRequest(shared, i) for i in range(n)]
+        for i in range(len(requests), 4):
+            requests.append(self._requestArray(self._channels[i], s, along_through, i))
         shape = list( slicing2shape(s) )
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
-        return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize )
+        return RGBAImageRequest( requests[0], requests[1], requests[2], requests[3],
+                                 shape, *self._layer._normalize, transposed=transposed )
+
+    def _sharedChannels( self ):
+        '''Number of leading channels that are consecutive channels of the
+        same multichannel source (see ChannelSource), and can therefore
+        be requested together.'''
+        channelOf = [getattr(c, 'channelOf', lambda: None)() for c in self._channels]
+        if channelOf[0] is None:
+            return 0
+        source, first = channelOf[0]
+        n = 1
+        while n < 4 and channelOf[n] is not None \
+              and channelOf[n][0] is source and channelOf[n][1] == first + n:
+            n += 1
+        return n
 assert issubclass(RGBAImageSource, SourceABC)
 
+class _ChannelRange( object ):
+    '''Consecutive channels of a multichannel source, given by their slice
+    sources, as one array source; its requests deliver 3d arrays
+    (channels last).'''
+    def __init__( self, sliceSources ):
+        self._sliceSources = sliceSources
+
+    @property
+    def through( self ):
+        return self._sliceSources[0].through
+
+    def request( self, slicing, along_through=None ):
+        first = self._sliceSources[0].channelOf()[1]
+        channels = slice(first, first + len(self._sliceSources))
+        request = self._sliceSources[0].requestChannels(slicing, channels, along_through)
+        return _ChannelRangeRequest(request, self._sliceSources, slicing, along_through)
+
+class _ChannelRangeRequest( object ):
+    '''Request of a _ChannelRange; the data of each channel is also
+    passed on to the statistics (min/max) of its slice source.'''
+    def __init__( self, arrayrequest, sliceSources, slicing, along_through ):
+        self._arrayreq = arrayrequest
+        self._sliceSources = sliceSources
+        self._slicing = slicing
+        self._along_through = along_through
+
+    def wait( self ):
+        return self._update(self._arrayreq.wait())
+
+    def getResult( self ):
+        return self._arrayreq.getResult()
+
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def notify( self, callback, **kwargs ):
+        self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(self._update(result), **kwargs)
+
+    def _update( self, a ):
+        for i, sliceSource in enumerate(self._sliceSources):
+            sliceSource.updateStatistics(self._slicing, self._along_through, a[:,:,i])
+        return a
+
+class _SharedRequest( object ):
+    '''Waits for an array request only once on behalf of several
+    _ChannelRequests.'''
+    def __init__( self, arrayrequest ):
+        self._arrayreq = arrayrequest
+        self._lock = threading.Lock()
+        self._result = None
+        # (callback, kwargs) of notify() calls before the result was known
+        self._callbacks = None
+
+    def wait( self ):
+        with self._lock:
+            if self._result is None:
+                self._result = self._arrayreq.wait()
+            return self._result
+
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def notify( self, callback, **kwargs ):
+        with self._lock:
+            result = self._result
+            first = False
+            if result is None:
+                first = self._callbacks is None
+                if first:
+                    self._callbacks = []
+                self._callbacks.append((callback, kwargs))
+        if result is not None:
+            callback(result, **kwargs)
+        elif first:
+            # the underlying request is only asked once
+            self._arrayreq.notify(self._onNotify)
+
+    def _onNotify( self, result ):
+        with self._lock:
+            if self._result is None:
+                self._result = result
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, kwargs in callbacks:
+            callback(self._result, **kwargs)
+
+class _ChannelRequest( object ):
+    '''Request for one channel of a _SharedRequest for several channels.'''
+    def __init__( self, shared, channel ):
+        self._shared = shared
+        self._channel = channel
+
+    def wait( self ):
+        return self._shared.wait()[:,:,self._channel]
+
+    def getResult( self ):
+        return self.wait()
+
+    def cancel( self ):
+        self._shared.cancel()
+
+    def notify( self, callback, **kwargs ):
+        self._shared.notify(self._onNotify, package = (callback, kwargs))
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(result[:,:,self._channel], **kwargs)
+assert issubclass(_ChannelRequest, RequestABC)
+
 class RGBAImageRequest( object ):
     def __init__( self, r, g, b, a, shape,
-                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None ):
+                  normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None,
+                  transposed=False ):
         self._mutex = QMutex()
         self._requests = r, g, b, a
         self._normalize = [normalizeR, normalizeG, normalizeB, normalizeA]
-        shape.append(4)
-        self._data = np.empty(shape, dtype=np.uint8)
+        self._transposed = transposed
+        # shape of the image (rows, columns)
+        self._shape = tuple(shape[::-1]) if transposed else tuple(shape)
         self._requestsFinished = 4 * [False,]
+        self.opacityHint = None
 
     def wait(self):
         for req in self._requests:
@@ -550,19 +1129,46 @@ class RGBAImageRequest( object ):
         return self.toImage()
 
     def toImage( self ):
-        for i, req in enumerate(self._requests):
-            a = req.getResult()
-            normalize = self._normalize[i]
-            if normalize is not None and \
-               normalize[0] < normalize[1]:
-                a = a.astype(np.float32)
-                a = (a - normalize[0])*255.0 / (normalize[1]-normalize[0])
-                a[a > 255] = 255
-                a[a < 0]   = 0
-                a = a.astype(np.uint8)
-            self._data[:,:,i] = a
-        img = array2qimage(self._data)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
+        img = get_image_pool().acquire(self._shape[1], self._shape[0], QImage.Format_ARGB32_Premultiplied)
+        out = byte_view(img) # B, G, R, A
+        alpha = out[:,:,3]
+        scratch = np.empty(self._shape, dtype=np.float32)
+        self._channel(3, alpha, scratch)
+        self.opacityHint = _opacityOf(alpha)
+        factor = None
+        if self.opacityHint != OPAQUE:
+            # premultiply the colors with alpha
+            factor = np.multiply(alpha, 1/255.0, dtype=np.float32)
+        for i in range(3):
+            self._channel(i, out[:,:,2-i], scratch, factor)
+        return img
+
+    def _channel( self, i, out, scratch, factor=None ):
+        '''Write channel i, normalized to 0..255 and multiplied with factor,
+        into the uint8 array out.'''
+        a = self._requests[i].getResult()
+        if self._transposed:
+            a = a.T
+        normalize = self._normalize[i]
+        if normalize is not None and \
+           normalize[0] < normalize[1]:
+            np.copyto(scratch, a, casting='unsafe')
+            scratch -= normalize[0]
+            scratch *= 255.0 / (normalize[1]-normalize[0])
+            np.clip(scratch, 0, 255, out=scratch)
+        else:
+            np.copyto(out, a, casting='unsafe')
+            if factor is None:
+                return
+            np.copyto(scratch, out)
+        if factor is not None:
+            scratch *= factor
+            scratch += 0.5
+        np.copyto(out, scratch, casting='unsafe')
+
+    def cancel( self ):
+        for req in self._requests:
+            req.cancel()
 
     def notify( self, callback, **kwargs ):
         for i in xrange(4):
@@ -584,16 +1190,22 @@ assert issubclass(RGBAImageRequest, RequestABC)
 
 class RandomImageSource( ImageSource ):
     '''Random noise image for testing and debugging.'''
-    def request( self, qrect, along_through=None ):
+    supportsLevels = True
+    supportsTransposed = True
+
+    def request( self, qrect, along_through=None, level=0, transposed=False ):
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = rect2slicing(qrect, step=2**level)
         shape = slicing2shape( s )
+        if transposed:
+            shape = shape[::-1]
         return RandomImageRequest( shape )
 assert issubclass(RandomImageSource, SourceABC)
 
 class RandomImageRequest( object ):
     def __init__( self, shape ):
         self.shape = shape
+        self.opacityHint = OPAQUE
 
     def wait(self):
         d = (np.random.random(self.shape) * 255).astype(np.uint8)        
@@ -601,6 +1213,9 @@ class RandomImageRequest( object ):
         img = gray2qimage(d)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
             
+    def cancel( self ):
+        pass
+
     def notify( self, callback, **kwargs ):
         img = self.wait()
         callback( img, **kwargs )
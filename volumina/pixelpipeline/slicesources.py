@@ -25,6 +25,7 @@ import numpy as np
 import volumina
 from volumina.slicingtools import SliceProjection, is_pure_slicing, intersection, sl
 from volumina.colorama import Fore
+from volumina.pixelpipeline.datasources import ChannelSource, MinMaxSource, stridesSupported
 
 projectionAlongTXC = SliceProjection( abscissa = 2, ordinate = 3, along = [0,1,4] )
 projectionAlongTYC = SliceProjection( abscissa = 1, ordinate = 3, along = [0,2,4] )
@@ -65,6 +66,30 @@ class SliceRequest( object ):
         callback(self._sp(result), **kwargs)
 assert issubclass(SliceRequest, RequestABC)
 
+class ChannelsRequest( SliceRequest ):
+    '''Like SliceRequest, but keeps the channel axis (the last axis of the
+    domain), i.e. the result is a 3d array (abscissa, ordinate, channel).'''
+    def _project( self, domainArray ):
+        sp = self._sp
+        slicing = sp.domainDim*[0]
+        slicing[sp.abscissa] = slicing[sp.ordinate] = slice(None,None)
+        slicing[-1] = slice(None,None)
+        projectedArray = domainArray[tuple(slicing)]
+        if sp.handednessSwitched():
+            projectedArray = np.swapaxes(projectedArray,0,1)
+        return projectedArray
+
+    def wait( self ):
+        return self._project(self._ar.wait())
+
+    def getResult(self):
+        return self._project(self._ar.getResult())
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(self._project(result), **kwargs)
+assert issubclass(ChannelsRequest, RequestABC)
+
 #*******************************************************************************
 # S l i c e S o u r c e                                                        *
 #*******************************************************************************
@@ -93,6 +118,10 @@ class SliceSource( QObject ):
             self._through = value
             self.throughChanged.emit(tuple(old), tuple(value))
             self.idChanged.emit(old_id, self.id)
+
+    @property
+    def supportsStrides( self ):
+        return stridesSupported(self._datasource)
     
     def __init__(self, datasource, sliceProjection = projectionAlongTZC):
         assert isinstance(datasource, SourceABC) , 'wrong type: %s' % str(type(datasource)) 
@@ -126,6 +155,52 @@ class SliceSource( QObject ):
 
         '''
         assert len(slicing2D) == 2
+        slicing = self._domainSlicing(slicing2D, along_through)
+        
+        if volumina.verboseRequests:
+            volumina.printLock.acquire()
+            print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
+            volumina.printLock.release()
+        return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
+
+    def channelOf( self ):
+        '''Return (multichannel source, channel) if the datasource is a
+        single channel of a multichannel source (see ChannelSource), also
+        if it is wrapped in a MinMaxSource (as by NormalizableLayer);
+        None otherwise.'''
+        channelSource = self._channelSource()
+        if channelSource is None:
+            return None
+        return channelSource.source, channelSource.channel
+
+    def _channelSource( self ):
+        datasource = self._datasource
+        if isinstance(datasource, MinMaxSource):
+            datasource = datasource.rawSource
+        if isinstance(datasource, ChannelSource):
+            return datasource
+        return None
+
+    def requestChannels( self, slicing2D, channels, along_through=None ):
+        '''Like request(), but for the range of channels 'channels' (a
+        slice) of the multichannel source the datasource is a channel of.
+
+        Returns: a ChannelsRequest for a 3d array
+
+        '''
+        assert self.channelOf() is not None
+        slicing = self._domainSlicing(slicing2D, along_through)
+        slicing = slicing[:-1] + (channels,)
+        return ChannelsRequest(self._channelSource().source.request(slicing), self.sliceProjection)
+
+    def updateStatistics( self, slicing2D, along_through, data ):
+        '''Pass data of this source that was requested by other means
+        (see requestChannels()) to its MinMaxSource, if there is one, so
+        that the bounds of the data stay up to date.'''
+        if isinstance(self._datasource, MinMaxSource):
+            self._datasource.update(self._domainSlicing(slicing2D, along_through), data)
+
+    def _domainSlicing( self, slicing2D, along_through ):
         # override through with caller values
         if along_through:
             through = list(self._through)
@@ -133,14 +208,7 @@ class SliceSource( QObject ):
                 through[axis] = value
         else:
            through = tuple(self._through)
-
-        slicing = self.sliceProjection.domain(through, slicing2D[0], slicing2D[1])
-        
-        if volumina.verboseRequests:
-            volumina.printLock.acquire()
-            print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
-            volumina.printLock.release()
-        return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
+        return self.sliceProjection.domain(through, slicing2D[0], slicing2D[1])
         
     def setDirty( self, slicing ):
         assert isinstance(slicing, tuple)
@@ -222,6 +290,12 @@ class SyncedSliceSources( QObject ):
     def getSyncAlong( self ):
         return self._sync_along
 
+    def idFor( self, through ):
+        '''Return the id the sources would have if the synced slice
+        sources were moved to 'through' (one value per along axis of
+        the slice sources).'''
+        return (self, tuple((axis, through[axis]) for axis in self._sync_along))
+
     def setThrough( self, index, value ):
         assert index < len(self.through)
         through = list(self.through)
@@ -120,9 +120,16 @@ def slicing2rect(slicing):
                  h.stop - h.start,
                  v.stop - v.start)
 
-def rect2slicing(qrect, seq=tuple):
-    result = seq((slice(qrect.x(), qrect.x() + qrect.width()),
-                  slice(qrect.y(), qrect.y() + qrect.height())))
+def rect2slicing(qrect, seq=tuple, step=None):
+    '''Convert a QRect to a 2d slicing.
+
+    step -- if given, only every step-th pixel is selected along both axes
+
+    '''
+    if step == 1:
+        step = None
+    result = seq((slice(qrect.x(), qrect.x() + qrect.width(), step),
+                  slice(qrect.y(), qrect.y() + qrect.height(), step)))
     return result
 
 def slicing2shape( slicing ):
@@ -130,9 +137,31 @@ def slicing2shape( slicing ):
     slicing = box(slicing)
     shape = []
     for sl in slicing:
-        shape.append(sl.stop - sl.start)
+        length = sl.stop - sl.start
+        if sl.step is not None and sl.step > 1:
+            length = (length + sl.step - 1) // sl.step
+        shape.append(length)
     return tuple(shape)
 
+def split_strides( slicing ):
+    '''Split a slicing into its contiguous part and the strides.
+
+    Returns (contiguous, strides), such that
+    array[slicing] == array[contiguous][strides]
+
+    For example: (slice(2,10,2), slice(0,5)) =>
+                 ((slice(2,10), slice(0,5)), (slice(None,None,2), slice(None)))
+
+    '''
+    slicing = box(slicing)
+    contiguous = tuple(slice(sl.start, sl.stop) for sl in slicing)
+    strides = tuple(slice(None, None, sl.step) for sl in slicing)
+    return contiguous, strides
+
+def is_strided( slicing ):
+    '''Test if any slice in the slicing has a step other than 1.'''
+    return any(sl.step not in (None, 1) for sl in box(slicing))
+
 def index2slice( slicing ):
     '''Convert integer indices to proper slice instances.
 
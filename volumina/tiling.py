@@ -22,22 +22,28 @@
 #Python
 import sys
 import time
+import heapq
 import collections
 import threading
+import weakref
 from collections import defaultdict, OrderedDict
+from functools import partial
 
 #SciPy
 import numpy
 
 #PyQt
-from PyQt4.QtCore import QRect, QRectF, QMutex, QObject, pyqtSignal
+from PyQt4.QtCore import QRect, QRectF, QPointF, QSize, QMutex, QObject, pyqtSignal
 from PyQt4.QtGui import QImage, QPainter, QTransform
 
 #volumina
 from patchAccessor import PatchAccessor
 import volumina
 from volumina.pixelpipeline.asyncabcs import IndeterminateRequestError
+from volumina.pixelpipeline.imagesources import TRANSPARENT, OPAQUE
+from volumina.pixelpipeline.imagepool import get_image_pool
 from volumina.utility import log_exception
+from volumina.config import cfg
 
 from concurrent.futures.thread import ThreadPoolExecutor, _WorkItem
 from concurrent.futures import _base
@@ -48,10 +54,15 @@ logger = logging.getLogger(__name__)
 
 
 
+# the layer stack as seen by a composite (see TileProvider._submitComposite):
+# (visible, opacity, image source) of the layers, their visibility and
+# whether they are occluded, each from top to bottom
+_StackSnapshot = collections.namedtuple('_StackSnapshot', ['layers', 'visible', 'occluded'])
+
 class RenderTask(_WorkItem):
     def __init__(self, f, prefetch, timestamp,
             tile_provider, ims, transform, tile_nr, stack_id, image_req,
-            cache):
+            cache, max_running=None):
         super(RenderTask, self).__init__(f, self._render, [], {})
 
         self.prefetch = prefetch
@@ -65,6 +76,23 @@ class RenderTask(_WorkItem):
         self.image_req = image_req
         self.timestamp = timestamp
         self.cache = cache
+        # maximal number of running tasks of the image source in the
+        # render pool (None: no limit)
+        self.max_running = max_running
+        # the RenderTaskExecutor the task was submitted to
+        self.pool = None
+        # squared distance from the point the user looks at
+        self.distance = tile_provider._tileDistance(tile_nr)
+
+    def run(self):
+        if self.pool is not None and not self.pool._startTask(self):
+            # parked until a task of the same image source has finished
+            return
+        try:
+            super(RenderTask, self).run()
+        finally:
+            if self.pool is not None:
+                self.pool._finishTask(self)
 
     def _render(self, *args, **kwds):
         """
@@ -79,6 +107,18 @@ class RenderTask(_WorkItem):
             threading.current_thread().name = "TileProvider-" + str( threading.current_thread().ident )
         
         try:
+            if not self.tile_provider._isTaskWanted(self):
+                # The user has left the slice before this task was started.
+                # Don't fetch any data for it.
+                self.cancel()
+                return
+
+            if self.ims is None:
+                # no layer to fetch, just composite the tile
+                self.tile_provider._compositeTile(self.stack_id, self.tile_nr,
+                                                  self.cache, self.timestamp)
+                return
+
             try:
                 with self.cache:
                     layerTimestamp = self.cache.layerTimestamp(self.stack_id,
@@ -88,11 +128,14 @@ class RenderTask(_WorkItem):
 
             if self.timestamp > layerTimestamp:
                 img = self.image_req.wait()
-                img = img.transformed(self.transform)
+                opacity = getattr(self.image_req, 'opacityHint', None)
+                img = self.tile_provider._finishLayerTile(img, self.transform,
+                                                          self.tile_nr, opacity)
                 try:
                     with self.cache:
                         self.cache.updateTileIfNecessary(self.stack_id,
-                            self.ims, self.tile_nr, self.timestamp, img)
+                            self.ims, self.tile_nr, self.timestamp, img,
+                            opaque=(opacity == OPAQUE))
                 except KeyError:
                     pass
 
@@ -103,26 +146,45 @@ class RenderTask(_WorkItem):
         except BaseException:
             sys.excepthook( *sys.exc_info() )
 
+    def cancel(self):
+        """
+        Abandon the underlying image request.
+        """
+        if hasattr(self.image_req, 'cancel'):
+            self.image_req.cancel()
+        if self.ims is None:
+            self.tile_provider._compositeAbandoned(self.stack_id, self.tile_nr,
+                                                   self.cache)
+
     def __lt__(self, other):
         """
         Compare two RenderTasks, where smallest has higher priority.
 
-        Regular render tasks have higher priority than prefetch tasks. A task
-        with higher timestamp has higher priority.
+        Regular render tasks have higher priority than prefetch tasks. Among
+        those, tiles closer to the focus of the view (see
+        TileProvider.setFocus) come first. A task with higher timestamp has
+        higher priority.
         """
         assert isinstance(self, RenderTask) and isinstance(other, RenderTask), \
             "Can't compare {} with {}".format( type(self), type(other) )
         res = cmp(self.prefetch, other.prefetch)
-        if res != 0:
-            return res
-        # note reversed order for timestamp
-        return cmp(other.timestamp, self.timestamp)
+        if res == 0:
+            res = cmp(self.distance, other.distance)
+        if res == 0:
+            # note reversed order for timestamp
+            res = cmp(other.timestamp, self.timestamp)
+        return res < 0
 
 
 class RenderTaskExecutor(ThreadPoolExecutor):
     def __init__(self, max_workers):
         super(RenderTaskExecutor, self).__init__(max_workers)
         self._work_queue = Queue.PriorityQueue()
+        # tasks with a max_running limit: image source -> number of
+        # running tasks, and -> heap of tasks waiting for one to finish
+        self._limit_lock = threading.Lock()
+        self._running = collections.Counter()
+        self._parked = {}
 
     def submit(self, *args):
         with self._shutdown_lock:
@@ -131,19 +193,141 @@ class RenderTaskExecutor(ThreadPoolExecutor):
 
             f = _base.Future()
             w = RenderTask(f, *args)
+            w.pool = self
 
             self._work_queue.put(w)
             self._adjust_thread_count()
             return f
 
+    def discard_tasks(self, predicate):
+        """
+        Remove all queued (not yet running) tasks for which predicate(task)
+        is true from the queue. Their futures are cancelled and their
+        image requests are abandoned.
+
+        Returns the number of discarded tasks.
+        """
+        q = self._work_queue
+        discarded = []
+        with q.mutex:
+            keep = []
+            for w in q.queue:
+                if isinstance(w, RenderTask) and predicate(w):
+                    discarded.append(w)
+                else:
+                    keep.append(w)
+            if discarded:
+                heapq.heapify(keep)
+                q.queue[:] = keep
+                q.unfinished_tasks -= len(discarded)
+                if q.unfinished_tasks <= 0:
+                    q.all_tasks_done.notify_all()
+        with self._limit_lock:
+            for ims, parked in self._parked.items():
+                keep = [w for w in parked if not predicate(w)]
+                if len(keep) < len(parked):
+                    discarded.extend(w for w in parked if w not in keep)
+                    heapq.heapify(keep)
+                    if keep:
+                        self._parked[ims] = keep
+                    else:
+                        del self._parked[ims]
+        if not discarded:
+            return 0
+
+        for w in discarded:
+            w.future.cancel()
+            w.cancel()
+        return len(discarded)
+
+    def reprioritize(self, predicate):
+        """
+        Recompute the focus distance of all queued tasks for which
+        predicate(task) is true and restore the queue order.
+        """
+        q = self._work_queue
+        with q.mutex:
+            for w in q.queue:
+                if isinstance(w, RenderTask) and predicate(w):
+                    w.distance = w.tile_provider._tileDistance(w.tile_nr)
+            heapq.heapify(q.queue)
+        with self._limit_lock:
+            for parked in self._parked.itervalues():
+                for w in parked:
+                    if predicate(w):
+                        w.distance = w.tile_provider._tileDistance(w.tile_nr)
+                heapq.heapify(parked)
+
+    def _startTask(self, w):
+        """
+        Called by a worker before running task w; returns False if the
+        image source of w has max_running tasks running already. w is
+        then parked until one of them has finished (see _finishTask).
+        """
+        if w.max_running is None:
+            return True
+        with self._limit_lock:
+            if self._running[w.ims] >= w.max_running:
+                heapq.heappush(self._parked.setdefault(w.ims, []), w)
+                return False
+            self._running[w.ims] += 1
+            return True
+
+    def _finishTask(self, w):
+        if w.max_running is None:
+            return
+        with self._limit_lock:
+            self._running[w.ims] -= 1
+            if self._running[w.ims] <= 0:
+                del self._running[w.ims]
+            parked = self._parked.get(w.ims)
+            if not parked:
+                return
+            next_task = heapq.heappop(parked)
+            if not parked:
+                del self._parked[w.ims]
+        self._work_queue.put(next_task)
+
 
 renderer_pool = None
+_renderer_pool_lock = threading.Lock()
+
+# image source -> RenderTaskExecutor of its own (see get_source_render_pool)
+_source_pools = weakref.WeakKeyDictionary()
 
 def get_render_pool():
+    """The render pool shared by all image sources; its number of
+    workers is the 'render_threads' config setting."""
     global renderer_pool
-    if renderer_pool is None:
-        renderer_pool = RenderTaskExecutor(6)
-    return renderer_pool
+    with _renderer_pool_lock:
+        if renderer_pool is None:
+            renderer_pool = RenderTaskExecutor(cfg.getint('pixelpipeline', 'render_threads'))
+        return renderer_pool
+
+def get_source_render_pool(ims, n_threads):
+    """A render pool used only by the image source ims, so that a slow
+    source cannot occupy the workers that render fast ones. The pool is
+    created with n_threads workers on first use; asking for more workers
+    later grows it, while a pool cannot shrink."""
+    with _renderer_pool_lock:
+        pool = _source_pools.get(ims)
+        if pool is None:
+            pool = RenderTaskExecutor(n_threads)
+            _source_pools[ims] = pool
+        elif n_threads > pool._max_workers:
+            # further workers are started as tasks are submitted
+            pool._max_workers = n_threads
+        elif n_threads < pool._max_workers:
+            logger.warning("render pool of %r keeps its %d workers, %d requested",
+                           ims, pool._max_workers, n_threads)
+        return pool
+
+def all_render_pools():
+    with _renderer_pool_lock:
+        pools = list(_source_pools.values())
+        if renderer_pool is not None:
+            pools.append(renderer_pool)
+        return pools
 
 #*******************************************************************************
 # I m a g e T i l e                                                            *
@@ -193,6 +377,49 @@ class ImageTile(object):
         self._mutex.unlock()
 
 
+def pyramidDepth(sliceShape, blockSize=256):
+    '''Number of pyramid levels needed until a single tile of the
+    coarsest level covers the whole slice.'''
+    levels = 1
+    while blockSize * 2**(levels-1) < max(sliceShape):
+        levels += 1
+    return levels
+
+def levelForScale(scale, nlevels):
+    '''Coarsest pyramid level that still provides at least one data
+    pixel per screen pixel when the scene is shown with the given scale.'''
+    level = 0
+    while level + 1 < nlevels and 2**(level+1) * scale <= 1.0:
+        level += 1
+    return level
+
+class _RectSequence(collections.Sequence):
+    '''Read-only sequence of QRect or QRectF objects which are created
+    on demand from an (n, 4) array of x, y, width and height.'''
+
+    def __init__(self, rects, rectType):
+        self._rects = rects
+        self._rectType = rectType
+
+    def __len__(self):
+        return len(self._rects)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        x, y, w, h = self._rects[i].tolist()
+        return self._rectType(x, y, w, h)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+def _roundHalfAway(a):
+    # same rounding as Python 2's round(), elementwise
+    return (numpy.sign(a) * numpy.floor(numpy.abs(a) + 0.5)).astype(numpy.int64)
+
 class Tiling(object):
     '''Tiling.__init__()
 
@@ -203,32 +430,71 @@ class Tiling(object):
     blockSize  -- base tile size: blockSize x blockSize (default 256)
     overlap    -- overlap between tiles positive number prevents rendering
                   artifacts between tiles for certain zoom levels (default 1)
+    level      -- pyramid level: the tile images of level l are
+                  downsampled by a factor of 2**l, i.e. each tile covers
+                  (blockSize*2**l)^2 data pixels (default 0)
+
+    The tile geometry is kept in numpy arrays; the rectangle sequences
+    (imageRectFs, tileRectFs, imageRects, tileRects, ...) create their
+    QRect/QRectF objects only when an element is accessed.
 
     '''
 
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=256, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", level=0):
         self.blockSize = blockSize
         self.overlap = overlap
+        self.level = level
+        self.downsample = 2**level
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
-                                            blockSize=self.blockSize)
+                                            blockSize=self.blockSize*self.downsample)
         self._overlap_draw = overlap_draw
         self._overlap = overlap
 
-        numPatches = self._patchAccessor.patchCount
-
-        self.imageRectFs = [None]*numPatches
-        self.dataRectFs  = [None]*numPatches
-        self.tileRectFs  = [None]*numPatches
-        self.imageRects  = [None]*numPatches
-        self.dataRects   = [None]*numPatches
-        self.tileRects   = [None]*numPatches
         self.sliceShape  = sliceShape
         self.name = name
+
+        # patch bounds in data coordinates, with and without overlap
+        self._dataBounds = self._patchBounds(self.overlap)
+        self._patchBounds0 = self._patchBounds(0)
+        x0, x1, y0, y1 = self._dataBounds
+        self.dataRects = _RectSequence(numpy.column_stack((x0, y0, x1-x0, y1-y0)), QRect)
+
         self.data2scene = data2scene
 
+    def _patchBounds(self, overlap):
+        '''Vectorized PatchAccessor.getPatchBounds() for all patches:
+        returns the arrays startx, endx, starty, endy.'''
+        pa = self._patchAccessor
+        bs = pa._blockSize
+        n = pa.patchCount
+        nums = numpy.arange(n, dtype=numpy.int64)
+        if n == 0:
+            return nums, nums, nums, nums
+        x = nums % pa._cX
+        y = nums // pa._cX
+        startx = numpy.maximum(0, x*bs - overlap)
+        endx = numpy.minimum(pa.size_x, (x+1)*bs + overlap)
+        endx[x+1 >= pa._cX] = pa.size_x
+        starty = numpy.maximum(0, y*bs - overlap)
+        endy = numpy.minimum(pa.size_y, (y+1)*bs + overlap)
+        endy[y+1 >= pa._cY] = pa.size_y
+        return startx, endx, starty, endy
+
+    @staticmethod
+    def _mapRects(t, bounds):
+        '''Vectorized QTransform.mapRect() for an affine transform t;
+        returns an (n, 4) float array of x, y, width and height.'''
+        x0, x1, y0, y1 = bounds
+        xs = numpy.array((x0, x1, x0, x1), dtype=numpy.float64)
+        ys = numpy.array((y0, y0, y1, y1), dtype=numpy.float64)
+        mx = t.m11()*xs + t.m21()*ys + t.dx()
+        my = t.m12()*xs + t.m22()*ys + t.dy()
+        left, top = mx.min(axis=0), my.min(axis=0)
+        return numpy.column_stack((left, top, mx.max(axis=0) - left, my.max(axis=0) - top))
+
     @property
     def data2scene(self):
         return self._data2scene
@@ -239,72 +505,93 @@ class Tiling(object):
         self.scene2data, isInvertible = data2scene.inverted()
         assert isInvertible
 
-        for patchNr in range(self._patchAccessor.patchCount):
-            # the patch accessor uses the data coordinate system.
-            # because the patch is drawn on the screen, its holds coordinates
-            # corresponding to Qt's QGraphicsScene's system, which need to be
-            # converted to scene coordinates
-
-            # the image rectangle includes an overlap margin
-            imageRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, self.overlap))
-
-            # the patch rectangle has per default no overlap
-            patchRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, 0))
-
-            # add a little overlap when the overlap_draw setting is
-            # activated
-            if self._overlap_draw != 0:
-                patchRectF = QRectF(patchRectF.x() - self._overlap_draw,
-                                    patchRectF.y() - self._overlap_draw,
-                                    patchRectF.width() + 2 * self._overlap_draw,
-                                    patchRectF.height() + 2 * self._overlap_draw)
-
-            patchRect = QRect(round(patchRectF.x()),
-                              round(patchRectF.y()),
-                              round(patchRectF.width()),
-                              round(patchRectF.height()))
-
-            # the image rectangles of neighboring patches can overlap
-            # slightly, to account for inaccuracies in sub-pixel
-            # rendering of many ImagePatch objects
-            imageRect = QRect(round(imageRectF.x()),
-                              round(imageRectF.y()),
-                              round(imageRectF.width()),
-                              round(imageRectF.height()))
-
-            self.imageRectFs[patchNr] = imageRectF
-            self.dataRectFs[ patchNr] = imageRectF
-            self.tileRectFs[ patchNr] = patchRectF
-            self.imageRects[ patchNr] = imageRect
-            self.tileRects[  patchNr] = patchRect
+        # the patch accessor uses the data coordinate system.
+        # because the patch is drawn on the screen, its holds coordinates
+        # corresponding to Qt's QGraphicsScene's system, which need to be
+        # converted to scene coordinates
+
+        # the image rectangle includes an overlap margin
+        imageRectFs = self._mapRects(data2scene, self._dataBounds)
+
+        # the patch rectangle has per default no overlap
+        tileRectFs = self._mapRects(data2scene, self._patchBounds0)
+
+        # add a little overlap when the overlap_draw setting is
+        # activated
+        if self._overlap_draw != 0:
+            tileRectFs[:, :2] -= self._overlap_draw
+            tileRectFs[:, 2:] += 2 * self._overlap_draw
 
+        # the image rectangles of neighboring patches can overlap
+        # slightly, to account for inaccuracies in sub-pixel
+        # rendering of many ImagePatch objects
+        self._imageRectArray = _roundHalfAway(imageRectFs)
+        self._tileRectFArray = tileRectFs
+
+        self.imageRectFs = _RectSequence(imageRectFs, QRectF)
+        self.dataRectFs  = self.imageRectFs
+        self.tileRectFs  = _RectSequence(tileRectFs, QRectF)
+        self.imageRects  = _RectSequence(self._imageRectArray, QRect)
+        self.tileRects   = _RectSequence(_roundHalfAway(tileRectFs), QRect)
 
     def boundingRectF(self):
-        if self.tileRectFs:
-            p = self.tileRectFs[-1]
-            br = QRectF(0,0, p.x()+p.width(), p.y()+p.height())
+        if len(self._tileRectFArray):
+            r = self._tileRectFArray
+            br = QRectF(0,0, (r[:,0] + r[:,2]).max(), (r[:,1] + r[:,3]).max())
         else:
             br = QRectF(0,0,0,0)
         return br
 
+    def _tileColumnRange(self, start, end, count):
+        # tile indices along one axis that overlap [start, end); the
+        # last tile may be enlarged by the patch accessor to the end
+        bs = self._patchAccessor._blockSize
+        s = min(max(int(numpy.floor(1.0 * start / bs)), 0), count - 1)
+        e = min(max(int(numpy.ceil(1.0 * end / bs)), s + 1), count)
+        return s, e
+
     def containsF(self, point):
-        for i, p in enumerate(self.tileRectFs):
-            if p.contains(point):
-                return i
+        pa = self._patchAccessor
+        if pa.patchCount == 0:
+            return None
+        p = self.scene2data.map(QPointF(point))
+        x, y = p.x(), p.y()
+        eps = self._overlap_draw
+        if not (-eps <= x <= pa.size_x + eps and -eps <= y <= pa.size_y + eps):
+            return None
+        # points on a common edge belong to the first tile, as before
+        bs = pa._blockSize
+        col = min(max(int(numpy.ceil(x / bs)) - 1, 0), pa._cX - 1)
+        row = min(max(int(numpy.ceil(y / bs)) - 1, 0), pa._cY - 1)
+        return row * pa._cX + col
 
     def intersected(self, sceneRect):
         if not sceneRect.isValid():
-            return range(len(self.tileRects))
+            return range(len(self))
+        if len(self) == 0:
+            return []
 
         # Patch accessor uses data coordinates
-        rect = self.data2scene.inverted()[0].mapRect(sceneRect)
-        patchNumbers = self._patchAccessor.getPatchesForRect(
-                            rect.topLeft().x(), rect.topLeft().y(),
-                            rect.bottomRight().x(), rect.bottomRight().y() )
-        return patchNumbers
+        pa = self._patchAccessor
+        rect = self.scene2data.mapRect(sceneRect)
+        sx, ex = self._tileColumnRange(rect.left(), rect.right(), pa._cX)
+        sy, ey = self._tileColumnRange(rect.top(), rect.bottom(), pa._cY)
+        if rect.right() < 0 or rect.bottom() < 0 \
+           or rect.left() > pa.size_x or rect.top() > pa.size_y:
+            return []
+        rows = numpy.arange(sy, ey) * pa._cX
+        return (rows[:, None] + numpy.arange(sx, ex)[None, :]).ravel().tolist()
+
+    def tileImageSize(self, tile_no):
+        '''Size of the (downsampled) image of the given tile in data
+        orientation.'''
+        x0, x1, y0, y1 = [int(b[tile_no]) for b in self._dataBounds]
+        w, h = x1 - x0, y1 - y0
+        d = self.downsample
+        return QSize((w + d - 1) // d, (h + d - 1) // d)
 
     def __len__(self):
-        return len(self.imageRectFs)
+        return self._patchAccessor.patchCount
 
 #*******************************************************************************
 # T i l e d I m a g e L a y e r                                                *
@@ -352,11 +639,48 @@ class _MultiCache( object ):
         del self.caches[uid]
         self.caches[uid] = c
 
+class _TransparentTile( object ):
+    """Stands in for the image of a fully transparent layer tile."""
+    def __repr__( self ):
+        return "<transparent tile>"
+
+# shared by all fully transparent layer tiles; it takes no memory and is
+# skipped when compositing
+TRANSPARENT_TILE = _TransparentTile()
+
+# layer id under which partial composites are accounted for in the LRU
+_PARTIAL = 'partial composite'
+
+# progress reported for a tile whose composite is queued for re-rendering
+_PENDING_PROGRESS = 0.99
+
+def _imageBytes( img ):
+    """Number of bytes occupied by the pixel buffer of a cached QImage."""
+    if img is None or img is TRANSPARENT_TILE:
+        return 0
+    return img.byteCount()
+
 class _TilesCache( object ):
-    def __init__(self, first_stack_id, sims, maxstacks=None):
+    """
+    Caches composited tiles and per-layer tiles for a number of stacks.
+
+    The cache can be bounded by the number of stacks (maxstacks) and/or by
+    the total number of bytes occupied by the stored QImages (maxbytes).
+    When the byte budget is exceeded, the least recently used images are
+    evicted across all stacks until the cache fits into its budget again.
+    Evicted entries are simply marked dirty, so that they are re-requested
+    the next time they are needed.
+    """
+    def __init__(self, first_stack_id, sims, maxstacks=None, maxbytes=None):
         self._lock = threading.Lock()
         self._sims = sims
 
+        self._maxbytes = maxbytes
+        self._usedbytes = 0
+        # (stack_id, layer_id, tile_id) -> bytes, in least recently used order.
+        # Composited tiles are stored with layer_id None.
+        self._lru = OrderedDict()
+
         kwargs = {'first_uid' : first_stack_id,
                   'maxcaches' : maxstacks}
         self._tileCache = _MultiCache(default_factory=lambda: (None, 0.), **kwargs)
@@ -364,6 +688,9 @@ class _TilesCache( object ):
         self._layerCache = _MultiCache(**kwargs)
         self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
         self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        self._layerCacheOpaque = _MultiCache(default_factory=bool, **kwargs)
+        self._tileCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        self._partialCache = _MultiCache(**kwargs)
 
     def __enter__(self):
         self._lock.acquire()
@@ -381,19 +708,40 @@ class _TilesCache( object ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         return len(self._tileCache.caches)
 
+    @property
+    def maxBytes( self ):
+        return self._maxbytes or 0
+
+    @property
+    def usedBytes( self ):
+        """Number of bytes currently occupied by all cached images."""
+        return self._usedbytes
+
     def tile( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._touchEntry( (stack_id, None, tile_id) )
         return self._tileCache.caches[stack_id][tile_id]
 
-    def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
+    def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded,
+                 layers=None ):
+        """
+        layers -- (visible, opacity, image source) of the layers the tile
+                  was composited from (default: the current layer stack)
+        """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         if len(stack_visible) > 0:
+            if layers is None:
+                imageSources = list(self._sims.viewImageSources())
+            else:
+                imageSources = [ims for visible, opacity, ims in layers]
             visible = numpy.asarray(stack_visible)
-            occluded = numpy.asarray(stack_occluded)
+            hidden = self.occludedLayers(stack_id, tile_id, layers)
+            occluded = numpy.asarray([o or ims in hidden for o, ims in
+                                      zip(stack_occluded, imageSources)])
             visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
             if numpy.count_nonzero(visibleAndNotOccluded) > 0:
                 dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
-                                       for ims in self._sims.viewImageSources()])
+                                       for ims in imageSources])
                 num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
                 denom = float(numpy.count_nonzero(visibleAndNotOccluded))
                 progress = 1.0 - num / denom
@@ -401,7 +749,46 @@ class _TilesCache( object ):
                 progress = 1.0
         else:
             progress = 1.0
+        old = self._tileCache.caches[stack_id].get(tile_id)
         self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        if old is not None and old[0] is not img:
+            get_image_pool().release(old[0])
+        self._storeEntry( (stack_id, None, tile_id), img )
+
+    def setTileIfNewer( self, stack_id, tile_id, img, stack_visible,
+                        stack_occluded, timestamp, layers=None ):
+        """
+        Like setTile(), but only if no composite that was started later
+        has been stored already. Returns whether the tile was stored.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        if timestamp < self._tileCacheTimestamp.caches[stack_id][tile_id]:
+            return False
+        self._tileCacheTimestamp.caches[stack_id][tile_id] = timestamp
+        self.setTile(stack_id, tile_id, img, stack_visible, stack_occluded, layers)
+        return True
+
+    def setTilePending( self, stack_id, tile_id ):
+        """
+        The composite of the tile is being re-rendered; until then, its
+        current image is reported as not quite complete.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        img, progress = self._tileCache.caches[stack_id][tile_id]
+        self._tileCache.caches[stack_id][tile_id] = (img, min(progress, _PENDING_PROGRESS))
+
+    def partialComposite( self, stack_id, tile_id ):
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        return self._partialCache.caches[stack_id][tile_id]
+
+    def setPartialComposite( self, stack_id, tile_id, partial ):
+        """
+        partial -- (layer signature of the partial composite, its image,
+                    layer signature of the last full composite)
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._partialCache.caches[stack_id][tile_id] = partial
+        self._storeEntry( (stack_id, _PARTIAL, tile_id), partial[1] )
 
     def tileDirty( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
@@ -428,12 +815,41 @@ class _TilesCache( object ):
 
     def layer(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._touchEntry( (stack_id, layer_id, tile_id) )
         return self._layerCache.caches[stack_id][(layer_id,tile_id)]
 
     def setLayer( self, stack_id, layer_id, tile_id, img ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
+        self._storeEntry( (stack_id, layer_id, tile_id), img )
+
+
+    def layerOpaque(self, stack_id, layer_id, tile_id ):
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        return self._layerCacheOpaque.caches[stack_id][(layer_id, tile_id)]
+
+    def occludedLayers( self, stack_id, tile_id, layers=None ):
+        """
+        Return the set of image sources that are hidden in the given tile
+        behind a fully opaque layer tile above them.
 
+        The opacity of a layer tile is known from the last time it was
+        rendered. As long as a tile has not been rendered at all, no layer
+        is considered occluded.
+
+        layers -- (visible, opacity, image source) from top to bottom
+                  (default: the current layer stack)
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        opaque = self._layerCacheOpaque.caches[stack_id]
+        occluded = set()
+        hidden = False
+        for visible, layerOpacity, ims in (self._sims if layers is None else layers):
+            if hidden:
+                occluded.add(ims)
+            elif visible and layerOpacity == 1.0 and opaque.get((ims, tile_id), False):
+                hidden = True
+        return occluded
 
     def layerDirty(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
@@ -475,11 +891,16 @@ class _TilesCache( object ):
 
     def addStack( self, stack_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._tileCache.add( stack_id )
+        old_stack_id = self._tileCache.add( stack_id )
+        if old_stack_id is not None:
+            self._forgetStack( old_stack_id )
         self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
         self._layerCache.add( stack_id )
         self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
         self._layerCacheTimestamp.add( stack_id, default_factory=float )
+        self._layerCacheOpaque.add( stack_id, default_factory=bool )
+        self._tileCacheTimestamp.add( stack_id, default_factory=float )
+        self._partialCache.add( stack_id )
 
 
     def touchStack( self, stack_id ):
@@ -489,19 +910,76 @@ class _TilesCache( object ):
         self._layerCache.touch( stack_id )
         self._layerCacheDirty.touch( stack_id )
         self._layerCacheTimestamp.touch( stack_id )
+        self._layerCacheOpaque.touch( stack_id )
+        self._tileCacheTimestamp.touch( stack_id )
+        self._partialCache.touch( stack_id )
 
 
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id,
-                               req_timestamp, img):
+                               req_timestamp, img, opaque=False):
+        """
+        img    -- the layer tile, or TRANSPARENT_TILE if it is fully transparent
+        opaque -- whether the layer tile is known to be fully opaque
+        """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
+            old = self._layerCache.caches[stack_id].get((layer_id, tile_id))
             self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
+            if old is not img:
+                get_image_pool().release(old)
+            self._layerCacheOpaque.caches[stack_id][(layer_id, tile_id)] = opaque
             self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
             self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
             self._tileCacheDirty.caches[stack_id][tile_id] = True
+            self._storeEntry( (stack_id, layer_id, tile_id), img )
+
+    def _touchEntry( self, key ):
+        if key in self._lru:
+            self._lru[key] = self._lru.pop(key)
+
+    def _storeEntry( self, key, img ):
+        """Account for a newly stored image and evict old ones if necessary."""
+        self._usedbytes -= self._lru.pop(key, 0)
+        nbytes = _imageBytes(img)
+        if nbytes > 0:
+            self._lru[key] = nbytes
+            self._usedbytes += nbytes
+        self._evict()
+
+    def _evict( self ):
+        """Drop least recently used images until the budget is met; their
+        buffers go to the image pool for reuse."""
+        if not self._maxbytes:
+            return
+        pool = get_image_pool()
+        # never evict the most recently stored image
+        while self._usedbytes > self._maxbytes and len(self._lru) > 1:
+            key, nbytes = self._lru.popitem(False)
+            self._usedbytes -= nbytes
+            stack_id, layer_id, tile_id = key
+            if layer_id is None:
+                img, progress = self._tileCache.caches[stack_id].pop(tile_id)
+                pool.release(img)
+                self._tileCacheDirty.caches[stack_id].pop(tile_id, None)
+            elif layer_id is _PARTIAL:
+                pool.release(self._partialCache.caches[stack_id].pop(tile_id)[1])
+            else:
+                pool.release(self._layerCache.caches[stack_id].pop((layer_id, tile_id)))
+                self._layerCacheDirty.caches[stack_id].pop((layer_id, tile_id), None)
+                self._layerCacheTimestamp.caches[stack_id].pop((layer_id, tile_id), None)
+                self._layerCacheOpaque.caches[stack_id].pop((layer_id, tile_id), None)
+                # the composite must be re-rendered (and thereby re-request the layer)
+                self._tileCacheDirty.caches[stack_id][tile_id] = True
+
+    def _forgetStack( self, stack_id ):
+        """Release the accounting for a stack that was dropped from the cache."""
+        for key in [k for k in self._lru if k[0] == stack_id]:
+            self._usedbytes -= self._lru.pop(key)
 
 
 class TileProvider( QObject ):
+    # qimg is in data orientation: it covers tiling.dataRects[id] and has to
+    # be drawn with tiling.data2scene to end up at rectF in the scene
     Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling')
     sceneRectChanged = pyqtSignal( QRectF )
 
@@ -512,10 +990,22 @@ class TileProvider( QObject ):
     cache_size                -- maximal number of encountered stacks
                                  to cache, i.e. slices if the imagesources
                                  draw from slicesources (default 10)
+    cache_bytes               -- memory budget in bytes for all cached tile
+                                 images; least recently used images are evicted
+                                 when it is exceeded (default: the
+                                 'tile_cache_bytes' config setting; 0 means
+                                 no limit)
     request_queue_size        -- maximal number of request to queue up (default 100000)
-    n_threads                 -- maximal number of request threads; this determines the
-                                 maximal number of simultaneously running requests
-                                 to the pixelpipeline (default: 2)
+    n_threads                 -- maximal number of request threads per image source;
+                                 if each image source has a render pool of its own,
+                                 the size of these pools (default: the
+                                 'source_render_threads' config setting), otherwise
+                                 the number of tasks of an image source that run at
+                                 once in the shared pool of 'render_threads' workers
+                                 (default: no limit)
+    pool_per_source           -- render the tiles of each image source in a separate
+                                 render pool instead of the shared one (default: the
+                                 'render_pool_per_source' config setting)
     layerIdChange_means_dirty -- layerId changes invalidate the cache; by default only
                                  stackId changes do that (default False)
     parent                    -- QObject
@@ -531,21 +1021,33 @@ class TileProvider( QObject ):
         self._axesSwapped = value
 
     def __init__( self, tiling, stackedImageSources, cache_size=100,
-                  request_queue_size=100000, n_threads=2,
-                  layerIdChange_means_dirty=False, parent=None ):
+                  request_queue_size=100000, n_threads=None,
+                  layerIdChange_means_dirty=False, parent=None,
+                  cache_bytes=None, pool_per_source=None ):
         QObject.__init__( self, parent = parent )
 
         self.tiling = tiling
         self.axesSwapped = False
         self._sims = stackedImageSources
         self._cache_size = cache_size
+        if cache_bytes is None:
+            cache_bytes = cfg.getint('pixelpipeline', 'tile_cache_bytes')
+        self._cache_bytes = cache_bytes
         self._request_queue_size = request_queue_size
+        if pool_per_source is None:
+            pool_per_source = cfg.getboolean('pixelpipeline', 'render_pool_per_source')
+        self._pool_per_source = pool_per_source
+        # limit of running tasks per image source in the shared pool
+        self._max_running = None if pool_per_source else n_threads
+        if n_threads is None:
+            n_threads = cfg.getint('pixelpipeline', 'source_render_threads')
         self._n_threads = n_threads
         self._layerIdChange_means_dirty = layerIdChange_means_dirty
 
         self._current_stack_id = self._sims.stackId
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
+                                  maxstacks=self._cache_size,
+                                  maxbytes=self._cache_bytes)
 
         self._sims.layerDirty.connect(self._onLayerDirty)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
@@ -558,6 +1060,35 @@ class TileProvider( QObject ):
 
         self._keepRendering = True
 
+        # stack ids for which prefetching was requested since the last
+        # change of the current stack
+        self._prefetch_stack_ids = set()
+
+        # scene point whose tiles are rendered first (see setFocus)
+        self._focus = None
+
+        # composites queued in the render pool:
+        # (cache, stack_id, tile_no) -> snapshot of the layer stack to use
+        self._queuedComposites = {}
+
+        # render tasks in flight: (stack_id, ims, tile_no) -> (future, prefetch)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # 'submitted': render tasks submitted to the render pool
+        # 'deduplicated': submissions dropped because an identical task was in flight
+        # 'prefetch_hits'/'prefetch_misses': newly shown stacks that were/weren't prefetched
+        self.stats = collections.Counter()
+
+    def cacheUsage( self ):
+        """Return (used bytes, byte budget) of the tile cache.
+
+        A budget of 0 means that the cache is only bounded by the number
+        of stacks.
+        """
+        with self._cache:
+            return self._cache.usedBytes, self._cache.maxBytes
+
     def getTiles( self, rectF ):
         '''Get tiles in rect and request a refresh.
 
@@ -580,6 +1111,23 @@ class TileProvider( QObject ):
                 progress,
                 self.tiling)
 
+    def cachedTiles( self, rectF ):
+        '''Get the tiles in rect that are cached and up to date, without
+        requesting anything.'''
+        stack_id = self._current_stack_id
+        for tile_no in self.tiling.intersected( rectF ):
+            with self._cache:
+                if self._cache.tileDirty(stack_id, tile_no):
+                    continue
+                qimg, progress = self._cache.tile(stack_id, tile_no)
+            if qimg is not None:
+                yield TileProvider.Tile(
+                    tile_no,
+                    qimg,
+                    QRectF(self.tiling.imageRects[tile_no]),
+                    progress,
+                    self.tiling)
+
     def waitForTiles(self, rectF=QRectF()):
         """
         This function is for testing purposes only.
@@ -600,10 +1148,28 @@ class TileProvider( QObject ):
 
         '''
         tile_nos = self.tiling.intersected( rectF )
+        if self._focus is not None:
+            tile_nos = sorted(tile_nos, key=self._tileDistance)
         for tile_no in tile_nos:
             stack_id = self._current_stack_id
             self._refreshTile( stack_id, tile_no )
 
+    def setFocus( self, pointF ):
+        '''Render the tiles closest to the given scene point first,
+        e.g. the center of the viewport. Queued render tasks are
+        reordered when the focus moves.'''
+        if self._focus is not None and QPointF(pointF) == self._focus:
+            return
+        self._focus = QPointF(pointF)
+        for pool in all_render_pools():
+            pool.reprioritize(lambda task: task.tile_provider is self)
+
+    def _tileDistance( self, tile_no ):
+        if self._focus is None:
+            return 0.0
+        d = self.tiling.imageRectFs[tile_no].center() - self._focus
+        return d.x()**2 + d.y()**2
+
     def prefetch( self, rectF, through ):
         '''Request fetching of tiles in advance.
 
@@ -615,7 +1181,12 @@ class TileProvider( QObject ):
 
         '''
         if self._cache_size > 1:
-            stack_id = (self._current_stack_id[0], enumerate(through))
+            stack_id = self._prefetchStackId(through)
+            if stack_id is None or stack_id == self._current_stack_id:
+                # either we can't tell under which id the stack will be
+                # shown or 'through' only differs in unsynced axes
+                return
+            self._prefetch_stack_ids.add(stack_id)
             with self._cache:
                 if stack_id not in self._cache:
                     self._cache.addStack(stack_id)
@@ -624,41 +1195,81 @@ class TileProvider( QObject ):
             for tile_no in tile_nos:
                 self._refreshTile( stack_id, tile_no, prefetch=True )
 
+    def cancelPrefetch( self ):
+        '''Drop all prefetch requests that have not been started yet.'''
+        self._prefetch_stack_ids = set()
+        self._discardStaleTasks()
+
+    def close( self ):
+        '''Stop using this tile provider.
+
+        Disconnects it from the image sources and drops its render tasks
+        that have not been started yet.
+        '''
+        self._keepRendering = False
+        self._sims.layerDirty.disconnect(self._onLayerDirty)
+        self._sims.visibleChanged.disconnect(self._onVisibleChanged)
+        self._sims.opacityChanged.disconnect(self._onOpacityChanged)
+        self._sims.sizeChanged.disconnect(self._onSizeChanged)
+        self._sims.orderChanged.disconnect(self._onOrderChanged)
+        self._sims.stackIdChanged.disconnect(self._onStackIdChanged)
+        if self._layerIdChange_means_dirty:
+            self._sims.layerIdChanged.disconnect(self._onLayerIdChanged)
+        self._prefetch_stack_ids = set()
+        self._discardStaleTasks()
+
+    def _prefetchStackId( self, through ):
+        """
+        The stack id the image sources will have once the slices are
+        moved to 'through'; it has to match the id announced by
+        stackIdChanged, otherwise the prefetched tiles are never used.
+        """
+        slices = self._current_stack_id[0]
+        if not hasattr(slices, 'idFor'):
+            return None
+        return slices.idFor(through)
+
+    def prefetchStats( self ):
+        """Return (hits, misses): how often a newly shown stack had (not)
+        been prefetched before."""
+        return self.stats['prefetch_hits'], self.stats['prefetch_misses']
+
     def _refreshTile( self, stack_id, tile_no, prefetch=False ):
         if not self.axesSwapped:
             transform = QTransform(0,1,0,1,0,0,1,1,1)
         else:
             transform = QTransform().rotate(90).scale(1,-1)
-        transform *= self.tiling.data2scene
 
         try:
             with self._cache:
                 tile_dirty = self._cache.tileDirty( stack_id, tile_no )
             if tile_dirty:
-                if not prefetch:
-                    with self._cache:
-                        self._cache.setTileDirty(stack_id, tile_no, False)
-                    img = self._renderTile( stack_id, tile_no )
-                    with self._cache:
-                        self._cache.setTile(stack_id, tile_no, img,
-                                            self._sims.viewVisible(),
-                                            self._sims.viewOccluded())
-
+                # layers below an opaque layer tile are not needed
+                with self._cache:
+                    occluded = self._cache.occludedLayers(stack_id, tile_no)
                 # refresh dirty layer tiles
                 for ims in self._sims.viewImageSources():
                     with self._cache:
                         layer_dirty = self._cache.layerDirty(stack_id, ims, tile_no)
                     if layer_dirty \
                        and not self._sims.isOccluded(ims) \
+                       and ims not in occluded \
                        and self._sims.isVisible(ims):
 
+                        if not (ims.direct and not prefetch) \
+                           and self._attachToInflight((stack_id, ims, tile_no), prefetch):
+                            # the very same layer tile is already being rendered
+                            continue
+
                         rect = self.tiling.imageRects[tile_no]
                         dataRect = self.tiling.scene2data.mapRect(rect)
                         try:
-                            ims_req = ims.request(dataRect, stack_id[1])
+                            ims_req = self._requestLayerTile(ims, dataRect, stack_id[1])
                         except IndeterminateRequestError:
                             sys.excepthook( *sys.exc_info() )
                         else:
+                            # sources that deliver data orientation need no transform
+                            layerTransform = None if self._deliversTransposed(ims) else transform
                             if ims.direct and not prefetch:
                                 # The ImageSource 'ims' is fast (it has the
                                 # direct flag set to true) so we process
@@ -667,8 +1278,9 @@ class TileProvider( QObject ):
                                 # that have the data readily available.
                                 start = time.time()
                                 img = ims_req.wait()
+                                opacity = getattr(ims_req, 'opacityHint', None)
     
-                                img = img.transformed(transform)
+                                img = self._finishLayerTile(img, layerTransform, tile_no, opacity)
                                 stop = time.time()
     
                                 ims._layer.timePerTile(stop-start,
@@ -676,47 +1288,293 @@ class TileProvider( QObject ):
     
                                 with self._cache:
                                     self._cache.updateTileIfNecessary(
-                                        stack_id, ims, tile_no, time.time(), img )
-                                img = self._renderTile( stack_id, tile_no )
-                                with self._cache:
-                                    self._cache.setTile(stack_id, tile_no,
-                                                        img, self._sims.viewVisible(),
-                                                        self._sims.viewOccluded() )
+                                        stack_id, ims, tile_no, time.time(), img,
+                                        opaque=(opacity == OPAQUE) )
                             else:
-                                pool = get_render_pool()
-                                pool.submit(prefetch, time.time(),
-                                        self, ims, transform, tile_no,
-                                        stack_id, ims_req, self._cache)
+                                pool = self._renderPool(ims)
+                                future = pool.submit(prefetch, time.time(),
+                                        self, ims, layerTransform, tile_no,
+                                        stack_id, ims_req, self._cache,
+                                        self._max_running)
+                                self._registerInflight((stack_id, ims, tile_no),
+                                                       future, prefetch)
+
+                if not prefetch:
+                    # composite what is there now (including the layers
+                    # processed synchronously above)
+                    with self._cache:
+                        tile_dirty = self._cache.tileDirty(stack_id, tile_no)
+                        if tile_dirty:
+                            self._cache.setTileDirty(stack_id, tile_no, False)
+                            self._cache.setTilePending(stack_id, tile_no)
+                    if tile_dirty:
+                        self._submitComposite(stack_id, tile_no)
         except KeyError:
             pass
 
-    def _renderTile( self, stack_id, tile_nr): 
-        qimg = None
-        p = None
-        for i, v in enumerate(reversed(self._sims)):
-            visible, layerOpacity, layerImageSource = v
-            if not visible:
-                continue
+    def _submitComposite( self, stack_id, tile_no ):
+        """
+        Composite the tile in a render thread. A composite that is
+        queued but not yet started already covers this request; it
+        uses the layer stack as of the latest request.
 
-            with self._cache:
-                patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
-            if patch is not None:
-                if qimg is None:
-                    qimg = QImage(self.tiling.imageRects[tile_nr].size(), QImage.Format_ARGB32_Premultiplied)
-                    qimg.fill(0xffffffff) # Use a hex constant instead.
-                    p = QPainter(qimg)
-                p.setOpacity(layerOpacity)
-                p.drawImage(0,0, patch)
-        
-        if p is not None:
-            p.end()
+        The render threads don't read the layer stack, which is changed
+        in the GUI thread, but a snapshot of it taken here.
+        """
+        key = (self._cache, stack_id, tile_no)
+        stack = self._stackSnapshot()
+        with self._inflight_lock:
+            queued = key in self._queuedComposites
+            self._queuedComposites[key] = stack
+            if queued:
+                return
+        future = get_render_pool().submit(False, time.time(), self, None, None,
+                                          tile_no, stack_id, None, self._cache)
+        future.add_done_callback(partial(self._onCompositeDone, key))
+
+    def _onCompositeDone( self, key, future ):
+        with self._inflight_lock:
+            self._queuedComposites.pop(key, None)
+
+    def _stackSnapshot( self ):
+        return _StackSnapshot(list(self._sims),
+                              list(self._sims.viewVisible()),
+                              list(self._sims.viewOccluded()))
+
+    def _compositeAbandoned( self, stack_id, tile_no, cache ):
+        # the composite was discarded before it ran, so the tile still
+        # needs one when it is shown again
+        try:
+            with cache:
+                cache.setTileDirty(stack_id, tile_no, True)
+        except KeyError:
+            pass
+
+    def _compositeTile( self, stack_id, tile_no, cache, timestamp ):
+        """
+        Render thread part of _submitComposite(): composite the layer
+        tiles and store the result.
+        """
+        with self._inflight_lock:
+            # from now on, changes of the layer tiles need a new composite
+            stack = self._queuedComposites.pop((cache, stack_id, tile_no), None)
+        if stack is None:
+            return
+        try:
+            img = self._renderTile(stack_id, tile_no, cache, stack.layers)
+            with cache:
+                stored = cache.setTileIfNewer(stack_id, tile_no, img,
+                                              stack.visible, stack.occluded,
+                                              timestamp, stack.layers)
+        except KeyError:
+            # the stack has been dropped from the cache in the meantime
+            return
+        if stored and stack_id == self._current_stack_id \
+                and cache is self._cache:
+            self.sceneRectChanged.emit(QRectF(self.tiling.imageRects[tile_no]))
+
+    def _requestLayerTile( self, ims, dataRect, through ):
+        """
+        Request the image of a layer tile at the pyramid level of the tiling.
+        Image sources that cannot downsample are asked for full
+        resolution; see _finishLayerTile().
+        """
+        kwargs = {}
+        level = self.tiling.level
+        if level > 0 and getattr(ims, 'supportsLevels', False):
+            kwargs['level'] = level
+        if self._deliversTransposed(ims):
+            kwargs['transposed'] = True
+        return ims.request(dataRect, through, **kwargs)
+
+    def _deliversTransposed( self, ims ):
+        """
+        Whether the layer tiles of 'ims' are requested transposed, i.e.
+        already in data orientation, which saves transforming them.
+        """
+        return getattr(ims, 'supportsTransposed', False)
+
+    def _finishLayerTile( self, img, transform, tile_no, opacity=None ):
+        """
+        Bring the image delivered by an image source into data
+        orientation and into the (possibly downsampled) tile size.
+        The view transform (data2scene) is only applied when drawing, so
+        that cached tiles survive rotating and swapping the view.
+        transform is None if the image already is in data orientation
+        (see _deliversTransposed()).
+
+        Fully transparent images (opacity hint TRANSPARENT) are replaced
+        by TRANSPARENT_TILE.
+        """
+        if opacity == TRANSPARENT:
+            get_image_pool().release(img)
+            return TRANSPARENT_TILE
+        tile = img if transform is None else img.transformed(transform)
+        size = self.tiling.tileImageSize(tile_no)
+        if tile.size() != size:
+            tile = tile.scaled(size)
+        if tile is not img:
+            get_image_pool().release(img)
+        return tile
+
+    def _attachToInflight( self, key, prefetch ):
+        """
+        Check whether a render task for key = (stack_id, ims, tile_no) is
+        already in flight. If so, the new submission is dropped in favour of
+        the existing one and True is returned.
+
+        A queued prefetch task is not good enough for a regular request,
+        since it would only run after all regular tasks. In that case the
+        prefetch task is discarded so that it can be re-submitted with the
+        proper priority.
+        """
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+        if entry is None:
+            return False
+        future, inflight_prefetch = entry
+        if inflight_prefetch and not prefetch:
+            n = self._renderPool(key[1]).discard_tasks(lambda task: task.future is future)
+            if n > 0:
+                return False
+        with self._inflight_lock:
+            self.stats['deduplicated'] += 1
+        return True
+
+    def _registerInflight( self, key, future, prefetch ):
+        with self._inflight_lock:
+            self._inflight[key] = (future, prefetch)
+            self.stats['submitted'] += 1
+        # if the task has already finished, the callback is invoked immediately
+        future.add_done_callback(partial(self._onInflightDone, key))
+
+    def _onInflightDone( self, key, future ):
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is future:
+                del self._inflight[key]
+
+    def _forgetInflight( self, ims=None ):
+        """
+        Stop attaching new submissions to the tasks currently in flight
+        (for all image sources or the given one only), e.g. because
+        their results are already outdated.
+        """
+        with self._inflight_lock:
+            if ims is None:
+                self._inflight.clear()
+            else:
+                for key in [k for k in self._inflight if k[1] is ims]:
+                    del self._inflight[key]
+
+    def _isTaskWanted( self, task ):
+        """
+        A render task is wanted as long as its result can still be shown,
+        i.e. its stack is current or a planned prefetch target, and the
+        cache it renders into has not been replaced. Only tasks for stacks
+        that are neither are stale, as are all tasks of a closed provider.
+        """
+        if not self._keepRendering or task.cache is not self._cache:
+            return False
+        if task.stack_id == self._current_stack_id:
+            # includes prefetch tasks for the stack the user just arrived at
+            return True
+        return task.stack_id in self._prefetch_stack_ids
+
+    def _discardStaleTasks( self ):
+        for pool in all_render_pools():
+            pool.discard_tasks(
+                lambda task: task.tile_provider is self and not self._isTaskWanted(task))
+
+    def _renderPool( self, ims ):
+        if self._pool_per_source:
+            return get_source_render_pool(ims, self._n_threads)
+        return get_render_pool()
+
+    def _renderTile( self, stack_id, tile_nr, cache=None, layers=None ):
+        """
+        Composite the visible layer tiles of a tile, bottom to top.
+
+        Besides the result, the composite of the layers below the layer
+        that changed last is kept in the cache. As long as only that
+        layer or the ones above it change (e.g. while the user drags an
+        opacity slider), only these layers are blended again.
+
+        Layers hidden behind an opaque layer tile are not blended at all.
+
+        layers -- (visible, opacity, image source) from top to bottom
+                  (default: the current layer stack)
+        """
+        if cache is None:
+            cache = self._cache
+        if layers is None:
+            layers = list(self._sims)
+        # (image source, opacity, timestamp of the layer tile) identifies
+        # what a layer contributes to the composite
+        signature = []
+        patches = []
+        anyLayer = False
+        with cache:
+            occluded = cache.occludedLayers(stack_id, tile_nr, layers)
+            for visible, layerOpacity, layerImageSource in reversed(layers):
+                if not visible or layerImageSource in occluded:
+                    continue
+                patch = cache.layer(stack_id, layerImageSource, tile_nr)
+                anyLayer = anyLayer or patch is not None
+                if patch is not None and patch is not TRANSPARENT_TILE:
+                    signature.append((layerImageSource, layerOpacity,
+                        cache.layerTimestamp(stack_id, layerImageSource, tile_nr)))
+                    patches.append(patch)
+            partial = cache.partialComposite(stack_id, tile_nr)
+
+        if not anyLayer:
+            return None
+
+        partialSignature, partialImage, lastSignature = partial or ([], None, [])
+        # index of the lowest layer that changed since the last composite
+        changed = 0
+        while changed < min(len(signature), len(lastSignature)) \
+              and signature[changed] == lastSignature[changed]:
+            changed += 1
+
+        n = len(partialSignature)
+        if partialImage is not None and signature[:n] == partialSignature:
+            qimg = partialImage.copy()
+            start = n
+        else:
+            size = self.tiling.tileImageSize(tile_nr)
+            qimg = get_image_pool().acquire(size.width(), size.height(),
+                                            QImage.Format_ARGB32_Premultiplied)
+            qimg.fill(0xffffffff) # Use a hex constant instead.
+            partialSignature, partialImage = [], None
+            start = 0
+
+        p = QPainter(qimg)
+        for i in range(start, len(patches)):
+            if i == changed and i > 0 and i != len(partialSignature):
+                # remember everything below the changed layer
+                p.end()
+                partialSignature, partialImage = signature[:i], qimg.copy()
+                p.begin(qimg)
+            p.setOpacity(signature[i][1])
+            p.drawImage(0,0, patches[i])
+        p.end()
 
+        try:
+            with cache:
+                cache.setPartialComposite(stack_id, tile_nr,
+                    (partialSignature, partialImage, signature))
+        except KeyError:
+            pass
         return qimg
     
     def _onLayerDirty(self, dirtyImgSrc, dataRect ):
         sceneRect = self.tiling.data2scene.mapRect(dataRect)
         if dirtyImgSrc not in self._sims.viewImageSources():
             return
+
+        # tasks in flight for this layer may deliver outdated data
+        self._forgetInflight(dirtyImgSrc)
         
         visibleAndNotOccluded = self._sims.isVisible( dirtyImgSrc ) \
                                 and not self._sims.isOccluded( dirtyImgSrc )
@@ -743,14 +1601,46 @@ class TileProvider( QObject ):
             self.sceneRectChanged.emit( QRectF(sceneRect) )
 
     def _onStackIdChanged( self, oldId, newId ):
+        with self._inflight_lock:
+            if newId in self._prefetch_stack_ids:
+                self.stats['prefetch_hits'] += 1
+            else:
+                self.stats['prefetch_misses'] += 1
         with self._cache:
             if newId in self._cache:
                 self._cache.touchStack( newId )
             else:
                 self._cache.addStack( newId )
         self._current_stack_id = newId
+        # Prefetches further ahead stay planned while the user keeps
+        # moving on; a change of course cancels them (see cancelPrefetch).
+        self._prefetch_stack_ids = self._stackIdsAhead(oldId, newId)
+        self._discardStaleTasks()
         self.sceneRectChanged.emit(QRectF())
 
+    def _stackIdsAhead( self, oldId, newId ):
+        """
+        The planned prefetch targets that lie ahead after moving from
+        stack oldId to newId, i.e. that are reached by moving on in the
+        same direction.
+        """
+        try:
+            old, new = dict(oldId[1]), dict(newId[1])
+        except (TypeError, ValueError, IndexError):
+            # not the ids of synced slice sources (see SyncedSliceSources.idFor)
+            return set()
+        if oldId[0] is not newId[0] or set(old) != set(new):
+            return set()
+        step = dict((axis, new[axis] - old[axis]) for axis in new)
+        ahead = set()
+        for stack_id in self._prefetch_stack_ids:
+            if stack_id[0] is not newId[0]:
+                continue
+            target = dict(stack_id[1])
+            if sum((target[axis] - new[axis]) * step[axis] for axis in step) > 0:
+                ahead.add(stack_id)
+        return ahead
+
     def _onLayerIdChanged( self, ims, oldId, newId ):
         if self._layerIdChange_means_dirty:
             self._onLayerDirty( ims, QRect() )
@@ -769,7 +1659,10 @@ class TileProvider( QObject ):
 
     def _onSizeChanged(self):
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
+                                  maxstacks=self._cache_size,
+                                  maxbytes=self._cache_bytes)
+        self._forgetInflight()
+        self._discardStaleTasks()
         self.sceneRectChanged.emit(QRectF())
 
     def _onOrderChanged(self):
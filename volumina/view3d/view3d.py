@@ -553,9 +553,9 @@ class OverviewScene(QWidget):
             actor.SetMapper(mapper)
             self.qvtk.registerObject(actor)
             self.objects.append(actor)
-            if self.colorTable:
+            if self.colorTable is not None and len(self.colorTable) > 0:
                 c = self.colorTable[i]
-                c = QColor.fromRgba(c)
+                c = QColor.fromRgba(int(c))
                 actor.GetProperty().SetColor(c.red()/255.0, c.green()/255.0, c.blue()/255.0)
             
             self.qvtk.renderer.AddActor(actor)
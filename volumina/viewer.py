@@ -34,7 +34,6 @@ from PyQt4.QtGui import QMainWindow, QApplication, QIcon, QAction, qApp
 from PyQt4.uic import loadUi
 
 import os
-import random
 
 _has_lazyflow = True
 try:
@@ -99,7 +98,7 @@ class ClickableSegmentationLayer(QObject):
     def labelColor(self, label):
         """ return the current color for object 'label' """
         color = self.layer.colorTable[label]
-        color = QColor.fromRgba(color)
+        color = QColor.fromRgba(int(color))
         return color
     
     def labelShown(self, label):
@@ -251,10 +250,17 @@ class Viewer(QMainWindow):
     def addRGBALayer(self, a, name=None):
         assert a.shape[2] >= 3
         sources = [None, None, None,None]
-        for i in range(3):
-            sources[i], self.dataShape = createDataSource(a[...,i], True)
-        if(a.shape[-1] >= 4):
-            sources[3], self.dataShape = createDataSource(a[...,3], True) 
+        if a.ndim == 3 and a.shape[2] <= 4:
+            # a single source for all channels, so that they are requested together
+            source, shape = createDataSource(a, True)
+            for i in range(a.shape[2]):
+                sources[i] = ChannelSource(source, i)
+            self.dataShape = shape[:-1] + (1,)
+        else:
+            for i in range(3):
+                sources[i], self.dataShape = createDataSource(a[...,i], True)
+            if(a.shape[-1] >= 4):
+                sources[3], self.dataShape = createDataSource(a[...,3], True) 
         layer = RGBALayer(sources[0],sources[1],sources[2], sources[3])
         if name:
             layer.name = name
@@ -305,17 +311,9 @@ class Viewer(QMainWindow):
     def _randomColors(self, M=256):
         """Generates a pleasing color table with M entries."""
 
-        colors = []
-        for i in range(M):
-            if i == 0:
-                colors.append(QColor(0, 0, 0, 0).rgba())
-            else:
-                h, s, v = random.random(), random.random(), 1.0
-                color = numpy.asarray(colorsys.hsv_to_rgb(h, s, v)) * 255
-                qColor = QColor(*color)
-                colors.append(qColor.rgba())
+        colors = generateRandomColors(M, "hsv", {"v": 1.0}, zeroIsTransparent=True)
         #for the first 16 objects, use some colors that are easily distinguishable
-        colors[1:17] = colortables.default16 
+        colors[1:17] = colortables.default16[:max(M-1, 0)]
         return colors
         
 if __name__ == "__main__":
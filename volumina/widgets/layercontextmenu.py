@@ -74,7 +74,7 @@ class LayerColortableDialog(QDialog):
         for i in range(len(layer._colorTable)): 
             item = QTableWidgetItem(" ")
             t.setItem(i,0, item);
-            item.setBackgroundColor(QColor.fromRgba(layer._colorTable[i]))
+            item.setBackgroundColor(QColor.fromRgba(int(layer._colorTable[i])))
             item.setFlags(Qt.ItemIsSelectable)
         
         h.addWidget(t)